@@ -6,6 +6,8 @@
 # The following are set after configuration is done:
 #  OVMF_FOUND
 #  OVMF_DISK_IMG
+#  OVMF_CODE_IMG     (optional, firmware code without the variable store)
+#  OVMF_VARS_IMG     (optional, template of the variable store)
 
 include(FindPackageHandleStandardArgs)
 
@@ -15,11 +17,19 @@ find_file(OVMF_DISK_IMG "OVMF.fd"
     PATHS "${OVMF_ROOT_DIR}" "/usr/share"
     PATH_SUFFIXES "ovmf" "qemu" "share")
 
+find_file(OVMF_CODE_IMG "OVMF_CODE.fd"
+    PATHS "${OVMF_ROOT_DIR}" "/usr/share"
+    PATH_SUFFIXES "ovmf" "qemu" "share")
+
+find_file(OVMF_VARS_IMG "OVMF_VARS.fd"
+    PATHS "${OVMF_ROOT_DIR}" "/usr/share"
+    PATH_SUFFIXES "ovmf" "qemu" "share")
+
 find_package_handle_standard_args(OVMF DEFAULT_MSG
     OVMF_DISK_IMG)
 
 if(OVMF_FOUND)
-    mark_as_advanced(OVMF_ROOT_DIR OVMF_DISK_IMG)
+    mark_as_advanced(OVMF_ROOT_DIR OVMF_DISK_IMG OVMF_CODE_IMG OVMF_VARS_IMG)
 
     if(NOT TARGET Ovmf::Ovmf)
         add_library(Ovmf::Ovmf UNKNOWN IMPORTED)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
-from os import path, environ
-from conans import ConanFile, tools
+from os import path, environ, symlink
+from conans import ConanFile, tools, python_requires
+
+git_mirror = python_requires("git-mirror/1.0@{:s}/testing".format(environ.get("USER", "")))
 
 class Edk2Conan(ConanFile):
     name = "edk2"
@@ -11,6 +13,8 @@ class Edk2Conan(ConanFile):
     url = "https://sourceforge.net/projects/gnu-efi/"
     license = "https://github.com/tianocore/edk2/blob/master/License.txt"
     settings = "os", "compiler", "build_type", "arch"
+    options = {"ccache": [True, False]}
+    default_options = "ccache=False"
     generators = "cmake"
     sources = "https://github.com/tianocore/edk2.git"
     source_dir = "{:s}-{:s}".format(name, version)
@@ -19,20 +23,48 @@ class Edk2Conan(ConanFile):
         # EDK2@master seems to be broken. OVMF image does not boot anymore.
         # Get an old version so that the EFI shell works.
 
-        # copy the repository but without the history (depth of 1)
-        self.run("git clone --depth 1 --branch {:s} {:s} {:s}"
-                 .format(self.version, self.sources, self.source_dir))
+        # the clone shares the objects of the local mirror instead of copying them
+        git_mirror.clone(self, self.source_dir, "--branch", self.version)
         #self.run("git clone --branch {:s} {:s} {:s}"
         #         .format(self.version, self.sources, self.source_dir))
         #with tools.chdir(self.source_dir):
         #    self.run("git checkout ba30d5f")
 
 
+    def _ccache_environment(self):
+        """
+            Route the compiler through ccache: a directory of links named after
+            the compilers comes first in PATH, and the cache is specific to the
+            settings so that profiles do not evict each other
+        """
+        ccache = tools.which("ccache")
+        if ccache is None:
+            self.output.warn("[EDK2] ccache not found, compiling without cache")
+            return {}
+        _masquerade_path = path.join(self.build_folder, "ccache-bin")
+        tools.mkdir(_masquerade_path)
+        for compiler in ("cc", "gcc", "g++", "c++", "clang", "clang++"):
+            link = path.join(_masquerade_path, compiler)
+            if not path.lexists(link):
+                symlink(ccache, link)
+        _cache_name = "edk2-{}-{}{}-{}".format(self.settings.os, self.settings.compiler,
+                                                self.settings.compiler.version,
+                                                self.settings.arch)
+        _cache_root = environ.get("CONAN_CCACHE_DIR",
+                                  path.join(path.expanduser("~"), ".conan", "ccache"))
+        self.output.info("[EDK2] ccache directory = {:s}".format(path.join(_cache_root, _cache_name)))
+        # paths relative to the workspace, so that every build folder hits the same entries
+        return {"PATH": _masquerade_path + ":" + environ["PATH"],
+                "CCACHE_DIR": path.join(_cache_root, _cache_name),
+                "CCACHE_BASEDIR": path.join(self.build_folder, self.source_dir),
+                "CCACHE_NOHASHDIR": "1"}
+
     def build(self):
-        with tools.chdir(self.source_dir):
+        _ccache_env = self._ccache_environment() if self.options.ccache else {}
+        with tools.chdir(self.source_dir), tools.environment_append(_ccache_env):
             self.output.info("[EDK2] build BaseTools")
-            self.output.info("make -C BaseTools")
-            self.run("make -C BaseTools")
+            self.output.info("make -C BaseTools -j {:d}".format(tools.cpu_count()))
+            self.run("make -C BaseTools -j {:d}".format(tools.cpu_count()))
 
             self.output.info("[EDK2] source edksetup.sh")
             self.run("bash -ex -c 'source edksetup.sh'")
@@ -42,11 +74,7 @@ class Edk2Conan(ConanFile):
             _compiler_major_ver = '{}'.format(self.settings.compiler.version).split('.')[0]
 
             _chain_tag = _compiler_name + _compiler_major_ver
-            tools.replace_in_file("Conf/target.txt",
-                                  "MYTOOLS",
-                                  _chain_tag)
             self.output.info("[EDK2] chaintag = {:s}".format(_chain_tag))
-            tools.replace_in_file("Conf/target.txt", "IA32", "X64")
             self.output.info("[EDK2] target architecture = X64")
 
             _workspace = path.join(self.build_folder, self.source_dir)
@@ -61,18 +89,13 @@ class Edk2Conan(ConanFile):
                                           }):
                 self.output.info("PATH={:s}".format(environ['PATH']))
 
-                # build MdeModulePkg
-                tools.replace_in_file("Conf/target.txt",
-                                      "Nt32Pkg/Nt32Pkg.dsc",
-                                      "MdeModulePkg/MdeModulePkg.dsc")
-                self.output.info("[EDK2] build MdeModulePkg")
-                self.run("build")
-                # build OvmfPkg
-                tools.replace_in_file("Conf/target.txt",
-                                      "MdeModulePkg/MdeModulePkg.dsc",
-                                      "OvmfPkg/OvmfPkgX64.dsc")
+                # build only the firmware images packaged, on every core
+                # (the command line overrides Conf/target.txt)
+                _build_cmd = "build -p OvmfPkg/OvmfPkgX64.dsc -a X64 -t {:s} -b DEBUG -n {:d}" \
+                             .format(_chain_tag, tools.cpu_count())
                 self.output.info("[EDK2] build OvmfPkgX64")
-                self.run("build")
+                self.output.info(_build_cmd)
+                self.run(_build_cmd)
 
     def package(self):
         _compiler_name = '{}'.format(self.settings.compiler).upper()
@@ -82,6 +105,10 @@ class Edk2Conan(ConanFile):
         self.copy("OVMF_CODE.fd", dst="share", src=path.join(self.source_dir, _ovmf_bin_path))
         self.copy("OVMF.fd", dst="share", src=path.join(self.source_dir, _ovmf_bin_path))
 
+    def package_id(self):
+        # the cache does not change the firmware images
+        del self.info.options.ccache
+
     def package_info(self):
         self.cpp_info.resdirs = ['share']
         self.env_info.OVMF_ROOT_DIR = self.package_folder
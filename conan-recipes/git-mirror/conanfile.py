@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import os
+from shlex import quote
+from conans import ConanFile, tools
+
+
+def git_mirror(conanfile):
+    """
+        Bare mirror of conanfile.sources in the local mirror cache (CONAN_GIT_MIRROR_DIR),
+        cloned on first use and fetched again only when CONAN_GIT_MIRROR_UPDATE is set,
+        so that the sources are available offline
+    """
+    mirror_root = os.environ.get("CONAN_GIT_MIRROR_DIR",
+                                 os.path.join(os.path.expanduser("~"), ".conan", "git-mirrors"))
+    mirror = os.path.join(mirror_root, "{:s}.git".format(conanfile.name))
+    if not os.path.isdir(mirror):
+        tools.mkdir(mirror_root)
+        conanfile.output.info("[{:s}] mirror {:s} into {:s}"
+                              .format(conanfile.name, conanfile.sources, mirror))
+        conanfile.run("git clone --mirror {:s} {:s}".format(quote(conanfile.sources),
+                                                            quote(mirror)))
+        # source trees borrow the objects of the mirror: never prune them
+        conanfile.run("git -C {:s} config gc.pruneExpire never".format(quote(mirror)))
+    elif os.environ.get("CONAN_GIT_MIRROR_UPDATE"):
+        conanfile.output.info("[{:s}] update mirror {:s}".format(conanfile.name, mirror))
+        conanfile.run("git -C {:s} fetch --prune origin".format(quote(mirror)))
+    return mirror
+
+def clone(conanfile, destination, *options):
+    """
+        Clone the sources of conanfile from the local mirror into destination,
+        sharing the objects of the mirror instead of copying them
+    """
+    conanfile.run("git clone --shared {:s} {:s} {:s}"
+                  .format(" ".join(quote(option) for option in options),
+                          quote(git_mirror(conanfile)), quote(destination)))
+
+
+class GitMirrorConan(ConanFile):
+    """
+        Helpers shared by the recipes through python_requires, nothing to build
+    """
+    name = "git-mirror"
+    version = "1.0"
+    description = """Clone the sources of a recipe from a local bare mirror cache."""
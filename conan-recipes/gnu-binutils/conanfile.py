@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-from os import path
+import shutil
+from os import path, listdir
 from conans import ConanFile, tools, AutoToolsBuildEnvironment
 
 class GNUbinutilsConan(ConanFile):
@@ -11,9 +12,15 @@ class GNUbinutilsConan(ConanFile):
     url = "http://ftp.gnu.org/gnu/binutils/"
     license = "GNU GPL"
     settings = "os", "compiler", "build_type", "arch"
+    # minimal: only the tools the EFI pipeline uses, for x86_64 ELF and PE
+    options = {"minimal": [True, False]}
+    default_options = "minimal=False"
     generators = "cmake"
     sources = "http://ftp.gnu.org/gnu/binutils/"
     source_dir = "{:s}-{:s}".format(name, version)
+    # program built in build-dir/binutils -> installed name
+    minimal_tools = (("objcopy", "objcopy"), ("objdump", "objdump"), ("readelf", "readelf"),
+                     ("nm-new", "nm"), ("strip-new", "strip"))
 
     def source(self):
         archive_name = self.source_dir + '.tar.gz'
@@ -25,14 +32,30 @@ class GNUbinutilsConan(ConanFile):
         with tools.chdir("build-dir"):
             env_build = AutoToolsBuildEnvironment(self)
             with tools.environment_append(env_build.vars):
-                self.run("{:s} --prefix={:s}"
+                configure_args = list()
+                if self.options.minimal:
+                    # no assemblers, linkers, debuggers, translations nor docs
+                    configure_args.extend(["--disable-gold", "--disable-ld", "--disable-gas",
+                                           "--disable-gprof", "--disable-nls", "--disable-gdb",
+                                           "--disable-sim", "--disable-readline",
+                                           "--disable-werror", "--enable-64-bit-bfd",
+                                           "--enable-targets=x86_64-pep"])
+                self.run("{:s} --prefix={:s} {:s}"
                          .format(path.join('..', self.source_dir, 'configure'),
-                                 self.package_folder))
-                self.run("make -j {:d}".format(tools.cpu_count()))
-                self.run("make install")
+                                 self.package_folder, " ".join(configure_args)))
+                if self.options.minimal:
+                    # binutils and its libraries only, MAKEINFO=true skips the docs
+                    self.run("make -j {:d} MAKEINFO=true all-binutils".format(tools.cpu_count()))
+                    tools.mkdir(path.join(self.package_folder, "bin"))
+                    for program, name in self.minimal_tools:
+                        shutil.copy2(path.join("binutils", program),
+                                     path.join(self.package_folder, "bin", name))
+                else:
+                    self.run("make -j {:d}".format(tools.cpu_count()))
+                    self.run("make install")
 
     def package(self):
-        # already done by 'make install'
+        # already done by 'make install' (or by build() for a minimal build)
         pass
 
     def package_info(self):
@@ -40,3 +63,5 @@ class GNUbinutilsConan(ConanFile):
         self.cpp_info.libdirs = ['lib']
         self.cpp_info.bindirs = ['bin']
         self.env_info.path.append(path.join(self.package_folder, "bin"))
+        # the installed programs, whether the build is minimal or not
+        self.user_info.tools = ",".join(sorted(listdir(path.join(self.package_folder, "bin"))))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import os
-from conans import ConanFile, tools
+from conans import ConanFile, tools, python_requires
 from conans.client.build.autotools_environment import AutoToolsBuildEnvironment
 
+git_mirror = python_requires("git-mirror/1.0@{:s}/testing".format(os.environ.get("USER", "")))
+
 class GNUefiConan(ConanFile):
     name = "gnu-efi"
     version = "3.0.6"
@@ -18,7 +20,8 @@ class GNUefiConan(ConanFile):
     source_dir = "{:s}-{:s}".format(name, version)
 
     def source(self):
-        self.run("git clone {:s} {:s}".format(self.sources, self.source_dir))
+        # the clone shares the objects of the local mirror instead of copying them
+        git_mirror.clone(self, self.source_dir, "--no-checkout")
         with tools.chdir(self.source_dir):
             self.run("git checkout tags/{:s}".format(self.version))
 
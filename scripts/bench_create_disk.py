@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import create_disk
+
+
+MB = 1024 * 1024
+
+def available_backends():
+    """
+        List the backends usable on this host
+    """
+    backends = ['native']
+    if shutil.which('mformat') and shutil.which('mcopy'):
+        backends.append('mtools')
+    if create_disk.is_user_root() and shutil.which('losetup') and shutil.which('mkfs.fat'):
+        backends.append('loopback-device')
+    return backends
+
+def available_partitioners():
+    """
+        List the partitioners usable on this host
+    """
+    partitioners = ['native']
+    if create_disk.pexpect is not None and shutil.which('gdisk'):
+        partitioners.append('gdisk')
+    return partitioners
+
+def make_payload(directory, file_count, file_size, depth):
+    """
+        Create file_count files of file_size bytes spread over depth levels of directories.
+        Return the paths to pass to create_disk.py.
+    """
+    root = os.path.join(directory, 'payload')
+    os.makedirs(root)
+    for index in range(file_count):
+        level = index % (depth + 1)
+        parent = os.path.join(root, *['dir{}'.format(number) for number in range(level)])
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(os.path.join(parent, 'test-{:04d}.efi'.format(index)), 'wb') as payloadf:
+            payloadf.write(os.urandom(file_size))
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))]
+
+def measure(function, repeat):
+    """
+        Time function() repeat times, return the durations in seconds
+    """
+    durations = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def bench_stages(workdir, disk_size, files, backend, partitioners, repeat):
+    """
+        Time each stage of the pipeline on its own
+    """
+    disk = os.path.join(workdir, 'stages.img')
+    layout = create_disk.plan_layout(create_disk.list_payload(files), disk_size)
+    stages = dict()
+    # sparse last: the following stages work on a sparse disk like the pipeline does
+    for mode in ('dd', 'preallocate', 'sparse'):
+        stages['allocate:' + mode] = measure(
+            lambda: create_disk.allocate(disk, disk_size, mode), repeat)
+    for partitioner in partitioners:
+        stages['partition:' + partitioner] = measure(
+            lambda: create_disk.partition_disk(disk, layout, partitioner), repeat)
+    create_disk.partition_disk(disk, layout)
+
+    if backend != 'loopback-device':
+        stages['format:' + backend] = measure(
+            lambda: create_disk.format_disk(disk, backend), repeat)
+        payload = create_disk.list_payload(files)
+        args = argparse.Namespace(output=disk, image=disk, files=files, pack=False,
+                                  seed=None, timestamp=None)
+        proceed = create_disk.proceed_natively if backend == 'native' \
+            else create_disk.proceed_as_standard_user
+        stages['copy:' + backend] = measure(
+            lambda: proceed(args, False, payload, list()), repeat)
+
+    clone = os.path.join(workdir, 'clone.img')
+    stages['clone'] = measure(lambda: create_disk.clone_file(disk, clone), repeat)
+    return stages
+
+def bench_run(workdir, disk_size, files, backend, options, repeat):
+    """
+        Time create_disk.run() end to end
+    """
+    disk = os.path.join(workdir, 'run.img')
+    argv = ['--tool', backend, '--disk-size', str(disk_size // MB), '-o', disk] + options + files
+    return measure(lambda: create_disk.run(create_disk.parse_args(argv)), repeat)
+
+def summary(durations):
+    """
+        Summarize a list of durations
+    """
+    return {'median': statistics.median(durations),
+            'min': min(durations),
+            'max': max(durations),
+            'runs': durations}
+
+def parse_args():
+    """
+        Parse the script arguments
+    """
+    def integers(value):
+        return [int(item) for item in value.split(',')]
+
+    parser = argparse.ArgumentParser(description='Benchmark the creation of disk images.')
+    parser.add_argument('-o', '--output', metavar='RESULTS',
+                        help='write the results to this JSON file (stdout by default)')
+    parser.add_argument('--disk-sizes', type=integers, default=[46, 256],
+                        metavar='MB,...', help='disk sizes in MB')
+    parser.add_argument('--file-counts', type=integers, default=[2, 100],
+                        metavar='N,...', help='number of payload files')
+    parser.add_argument('--file-sizes', type=integers, default=[4096, 1 << 20],
+                        metavar='BYTES,...', help='size of each payload file')
+    parser.add_argument('--depths', type=integers, default=[0, 3],
+                        metavar='N,...', help='depth of the payload directories')
+    parser.add_argument('--backends', type=lambda value: value.split(','),
+                        default=available_backends(),
+                        metavar='NAME,...', help='backends to benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each measure')
+    return parser.parse_args()
+
+def run(args):
+    """
+        main function
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    partitioners = available_partitioners()
+    results = list()
+    for disk_size, file_count, file_size, depth, backend in itertools.product(
+            args.disk_sizes, args.file_counts, args.file_sizes, args.depths, args.backends):
+        case = {'disk_size': disk_size * MB, 'file_count': file_count,
+                'file_size': file_size, 'depth': depth, 'backend': backend}
+        if file_count * file_size * 2 > disk_size * MB:
+            continue
+        sys.stderr.write("bench {}\n".format(json.dumps(case, sort_keys=True)))
+        workdir = tempfile.mkdtemp(prefix='bench-create-disk-')
+        try:
+            files = make_payload(workdir, file_count, file_size, depth)
+            result = dict(case)
+            try:
+                result['stages'] = dict(
+                    (name, summary(durations)) for name, durations in
+                    bench_stages(workdir, disk_size * MB, files, backend,
+                                 partitioners, args.repeat).items())
+                timed = lambda options: summary(bench_run(workdir, disk_size * MB, files,
+                                                          backend, options, args.repeat))
+                result['run'] = {
+                    'cold': timed(['--force-dd', '--no-golden']),
+                    'golden': timed(['--force-dd']),
+                    'up-to-date': timed(list()),
+                }
+            except Exception as error:
+                result['error'] = '{}: {}'.format(type(error).__name__, error)
+            results.append(result)
+        finally:
+            shutil.rmtree(workdir)
+
+    report = {'host': {'platform': platform.platform(),
+                       'python': platform.python_version(),
+                       'cpus': os.cpu_count()},
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as outputf:
+            json.dump(report, outputf, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import time
+
+import create_disk
+
+
+def load_specs(manifest):
+    """
+        Read the image specifications from a JSON manifest:
+        {
+            "images": [
+                {
+                    "output": "gcc/uefi.img",
+                    "files": ["gcc/bin/hello-world.efi", "efi_scripts/startup.nsh"],
+                    "options": ["--tool=native"]
+                }
+            ]
+        }
+        Relative paths are relative to the manifest directory.
+    """
+    with open(manifest) as manifestf:
+        content = json.load(manifestf)
+    basedir = os.path.dirname(os.path.abspath(manifest))
+    specs = list()
+    outputs = set()
+    for image in content['images']:
+        output = os.path.join(basedir, image['output'])
+        if output in outputs:
+            raise ValueError("{output} is built twice".format(output=output))
+        outputs.add(output)
+        argv = list(image.get('options', list()))
+        argv.extend(['-o', output])
+        argv.extend(os.path.join(basedir, name) for name in image['files'])
+        specs.append(argv)
+    return specs
+
+def init_worker(digests, level):
+    """
+        Share the payload digests computed by the parent with a worker
+    """
+    logging.getLogger().setLevel(level)
+    create_disk.Manifest.digests.update(digests)
+
+def build_image(args):
+    """
+        Build one image exactly as create_disk.py would, and report the result
+    """
+    start = time.time()
+    result = {'output': args.output, 'status': 'ok', 'error': None}
+    try:
+        create_disk.run(args)
+    except Exception as error:
+        logging.exception("%s: build failed", args.output)
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    result['seconds'] = time.time() - start
+    return result
+
+def hash_payloads(images, executor):
+    """
+        Hash every distinct payload file once for all the images
+    """
+    paths = set()
+    for args in images:
+        for syspath, _ in create_disk.list_payload(args.files):
+            if not os.path.isdir(syspath):
+                paths.add(os.path.abspath(syspath))
+    for path, digest in zip(paths, executor.map(create_disk.Manifest.hash, paths)):
+        stat = os.stat(path)
+        create_disk.Manifest.digests[(path, stat.st_size, stat.st_mtime_ns)] = digest
+    return create_disk.Manifest.digests
+
+def parse_args():
+    """
+        Parse the script arguments
+    """
+    parser = argparse.ArgumentParser(description='Build concurrently the disk images '\
+                                     'described in a manifest.')
+    parser.add_argument('manifest', metavar='MANIFEST',
+                        help='JSON file describing the images to build')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=os.cpu_count(),
+                        help='number of images built at the same time')
+    parser.add_argument('--pool', choices=['process', 'thread'],
+                        default='process',
+                        help='threads are enough when external tools do the work')
+    parser.add_argument('--report', metavar='REPORT',
+                        help='write the per image results to this JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every step of every build')
+    return parser.parse_args()
+
+def run(args):
+    """
+        main function
+    """
+    level = logging.INFO if args.verbose else logging.WARNING
+    logging.getLogger().setLevel(level)
+    # parse everything first so that an invalid spec fails before any build
+    images = [create_disk.parse_args(argv) for argv in load_specs(args.manifest)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        digests = hash_payloads(images, executor)
+
+    start = time.time()
+    if args.pool == 'thread':
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                          initializer=init_worker,
+                                                          initargs=(digests, level))
+    with executor:
+        results = list(executor.map(build_image, images))
+    elapsed = time.time() - start
+
+    for result in results:
+        print("{status:6s} {seconds:7.3f}s {output}".format(**result))
+        if result['error']:
+            print("       {error}".format(**result))
+    failures = sum(1 for result in results if result['status'] != 'ok')
+    print("{} images built in {:.3f}s, {} failed".format(len(results) - failures,
+                                                       elapsed, failures))
+    if args.report:
+        with open(args.report, 'w') as reportf:
+            json.dump({'seconds': elapsed, 'images': results}, reportf, indent=2)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(run(parse_args()))
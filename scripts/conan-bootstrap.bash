@@ -14,6 +14,8 @@ __root="$(cd "$(dirname "${__dir}")" && pwd)"
 
 _EXPORTED=()
 _IGNORE=("gnu-binutils" "edk2")
+# exported first: the recipes load it through python_requires, it is not a requirement
+_PYTHON_REQUIRES=("git-mirror")
 
 function in_array()
 {
@@ -31,6 +33,16 @@ function in_array()
 
 pushd . >/dev/null
 cd ${__root}
+for _pkgname in ${_PYTHON_REQUIRES[@]}; do
+    _version=$(sed -n -e 's/^[[:space:]]*version = ["'\'']\(.*\)["'\'']$/\1/p' \
+                   "${__root}/conan-recipes/${_pkgname}/conanfile.py")
+    _conan_export_pkgname="${_pkgname}/${_version}@${USER}/testing"
+    pushd . >/dev/null
+    cd "${__root}/conan-recipes/${_pkgname}"
+    echo -e " * conan export --file conanfile.py ${_conan_export_pkgname}"
+    conan export --file "conanfile.py" "${_conan_export_pkgname}"
+    popd >/dev/null
+done
 for conanfile in $(find "${__root}/conan-recipes" -type f -name "conanfile.py"); do
     _pkgname=$(sed -n -e 's/^[[:space:]]*name = ["'\'']\(.*\)["'\'']$/\1/p' "${conanfile}")
     _version=$(sed -n -e 's/^[[:space:]]*version = ["'\'']\(.*\)["'\'']$/\1/p' "${conanfile}")
@@ -42,6 +54,10 @@ for conanfile in $(find "${__root}/conan-recipes" -type f -name "conanfile.py");
         echo -e "\tblacklisted: ignore ${_basedir_conanfile}"
         continue
     fi
+    if [[ "$(in_array _PYTHON_REQUIRES[@] "${_basedir_conanfile}")" = "true" ]]; then
+        echo -e "\tpython_requires: already exported"
+        continue
+    fi
 
     _conan_export_pkgname="${_pkgname}/${_version}@${USER}/testing"
     pushd . >/dev/null
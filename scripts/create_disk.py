@@ -2,14 +2,146 @@
 # coding: utf8
 
 import argparse
+import array
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import glob
+import hashlib
+import json
+import mmap
 import os
+import posixpath
+import resource
+import select
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import logging
-import pexpect
+import uuid
+import zlib
+from collections import namedtuple
+from stat import S_ISBLK, S_ISREG
+
+try:
+    import pexpect
+except ImportError:
+    # only needed by the interactive partitioners (gdisk, parted)
+    pexpect = None
+
+
+# the blocks written by a stage are counted for its thread only, where supported
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+class Metrics(object):
+    """
+        Instrumentation of the pipeline. Every stage produces a structured event
+        holding its wall time, the bytes written, the subprocesses started and the
+        peak RSS so far of the process and of its largest child (the kernel only
+        tracks lifetime maximums, not per stage ones). Events are kept for the
+        JSON report and passed to the hooks.
+        Events, hooks and running stages belong to the calling thread, so that
+        concurrent runs in threads (build_images.py --pool thread) stay apart;
+        only the figures of the child processes are shared by the threads.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _state(self):
+        if not hasattr(self._local, 'events'):
+            self._local.events = list()
+            self._local.hooks = list()
+            self._local.active = list()
+        return self._local
+
+    @property
+    def events(self):
+        return self._state().events
+
+    @property
+    def hooks(self):
+        return self._state().hooks
+
+    def reset(self):
+        """
+            Forget the events of a previous run
+        """
+        self._state().events = list()
+        self._state().active = list()
+
+    @contextlib.contextmanager
+    def stage(self, name, **details):
+        """
+            Measure the enclosed block as a stage, nested stages are included
+        """
+        state = self._state()
+        counters = {'bytes_written': 0, 'subprocesses': 0}
+        state.active.append(counters)
+        usage = resource.getrusage(RUSAGE_THREAD)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            seconds = time.time() - start
+            state.active = [active for active in state.active if active is not counters]
+            end_usage = resource.getrusage(RUSAGE_THREAD)
+            end_children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            event = dict(details)
+            event.update(counters)
+            event.update({'stage': name,
+                          'status': status,
+                          'start': start,
+                          'seconds': seconds,
+                          'blocks_out': end_usage.ru_oublock - usage.ru_oublock
+                                        + end_children_usage.ru_oublock
+                                        - children_usage.ru_oublock,
+                          'process_peak_rss_kb': end_usage.ru_maxrss,
+                          'children_peak_rss_kb': end_children_usage.ru_maxrss})
+            state.events.append(event)
+            logging.debug("stage %s: %.6fs, %d bytes written, %d subprocesses",
+                          name, seconds, counters['bytes_written'], counters['subprocesses'])
+            for hook in state.hooks:
+                hook(event)
+
+    def add_bytes(self, count):
+        """
+            Account bytes written to the running stages
+        """
+        for counters in self._state().active:
+            counters['bytes_written'] += count
+
+    def add_subprocess(self):
+        """
+            Account a subprocess started by the running stages
+        """
+        for counters in self._state().active:
+            counters['subprocesses'] += 1
+
+    def report(self, path):
+        """
+            Write the events to a JSON file
+        """
+        with open(path, 'w') as reportf:
+            json.dump({'events': self.events}, reportf, indent=2)
+
+metrics = Metrics()
+
+def check_output(args, **kwargs):
+    """
+        subprocess.check_output, accounted in the metrics
+    """
+    metrics.add_subprocess()
+    return subprocess.check_output(args, **kwargs)
 
 
 def is_user_root():
@@ -23,7 +155,27 @@ def is_user_root():
         logging.debug("UID=%s", uid)
     return uid == 0
 
-def mkfsFAT32(device):
+# first date a FAT directory entry can hold, the timestamp of a seeded build
+# without SOURCE_DATE_EPOCH
+FAT_EPOCH = 315532800
+
+def seeded_guid(seed, name):
+    """
+        GUID derived from a seed and the name of what it identifies,
+        a random one without seed
+    """
+    if seed is None:
+        return uuid.uuid4()
+    digest = hashlib.sha256('{}:{}'.format(seed, name).encode('utf-8')).digest()
+    return uuid.UUID(bytes=digest[:16], version=4)
+
+def seeded_volume_id(seed):
+    """
+        FAT volume ID (serial number) derived from a seed, a random one without seed
+    """
+    return seeded_guid(seed, 'volume-id').int & 0xffffffff
+
+def mkfsFAT32(device, sectors_per_cluster=None, volume_id=None):
     """
         Format the given device to FAT32
     """
@@ -31,35 +183,416 @@ def mkfsFAT32(device):
     args.append('mkfs.fat')
     args.append('-I')
     args.append('-F 32')
+    if sectors_per_cluster is not None:
+        args.extend(['-s', str(sectors_per_cluster)])
+    if volume_id is not None:
+        args.extend(['-i', '{:08x}'.format(volume_id)])
     args.append(device)
     logging.info("formatting %s in FAT32", device)
-    subprocess.check_output(args)
+    check_output(args)
+
+# largest chunk moved by one system call, or held in memory when copying by hand
+COPY_CHUNK = 8 << 20
 
 def dd(outputf, size, inputf='/dev/zero', bs=512, skip=None, seek=None):
     """
-        Wrapper for the system command 'dd' (see manual for more information)
+        In-process equivalent of the system command 'dd' (see manual for more
+        information): copy size bytes (rounded down to bs) from inputf, skip
+        blocks in, to outputf, seek blocks in, which is truncated there first.
+        Zeros from /dev/zero are written (the blocks get allocated), the holes
+        of a sparse input file stay holes. Return the number of bytes written.
     """
     count = int(size / bs)
-    args = list()
-    args.append('dd')
-    args.append('if={}'.format(inputf))
-    args.append('of={}'.format(outputf))
-    args.append('bs={}'.format(bs))
-    if skip is not None:
-        args.append('skip={}'.format(skip))
-    if seek is not None:
-        args.append('seek={}'.format(seek))
-    args.append('count={}'.format(count))
-    logging.info("creating zeroed disk %s", outputf)
-    subprocess.check_output(args)
+    length = count * bs
+    source_offset = (skip or 0) * bs
+    destination_offset = (seek or 0) * bs
+    # chunks are multiples of the block size
+    chunk = max(COPY_CHUNK // bs, 1) * bs
+    logging.info("dd: %s to %s, %d bytes", inputf, outputf, length)
+    # no O_APPEND, the writes are positioned
+    destination_fd = os.open(outputf, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        os.ftruncate(destination_fd, destination_offset)
+        os.ftruncate(destination_fd, destination_offset + length)
+        if os.path.realpath(inputf) == '/dev/zero':
+            return write_zeros(destination_fd, destination_offset, length, chunk)
+        with open(inputf, 'rb') as inputfile:
+            status = os.fstat(inputfile.fileno())
+            if S_ISREG(status.st_mode):
+                # like dd, stop at the end of the input
+                length = max(min(length, status.st_size - source_offset), 0)
+                os.ftruncate(destination_fd, destination_offset + length)
+                return copy_sparse(inputfile.fileno(), destination_fd, source_offset,
+                                   length, destination_offset, chunk)
+            if S_ISBLK(status.st_mode):
+                return _copy_range(inputfile.fileno(), destination_fd, source_offset,
+                                   length, destination_offset, chunk)
+            # pipes and character devices are read in sequence
+            if source_offset:
+                os.lseek(inputfile.fileno(), source_offset, os.SEEK_SET)
+            written = 0
+            while written < length:
+                data = inputfile.read(min(chunk, length - written))
+                if not data:
+                    break
+                written += os.pwrite(destination_fd, data, destination_offset + written)
+            os.ftruncate(destination_fd, destination_offset + written)
+            metrics.add_bytes(written)
+            return written
+    finally:
+        os.close(destination_fd)
+
+def write_zeros(fd, offset, length, chunk=COPY_CHUNK):
+    """
+        Write length zeros at offset, chunk bytes at a time, return the bytes written
+    """
+    zeros = memoryview(bytes(min(chunk, length)))
+    written = 0
+    while written < length:
+        written += os.pwrite(fd, zeros[:length - written], offset + written)
+    metrics.add_bytes(written)
+    return written
+
+def allocate(outputf, size, mode='sparse', bs=512):
+    """
+        Create a zeroed disk file of the given size (rounded down to bs like dd).
+        Modes:
+            - sparse: only set the file size, no block is written
+            - preallocate: reserve the blocks without writing them (fallocate)
+            - dd: write zeros through dd(), every block gets allocated
+    """
+    size = int(size / bs) * bs
+    with metrics.stage('allocate', mode=mode, size=size):
+        if mode == 'dd':
+            dd(outputf, size, bs=bs)
+            return
+        logging.info("allocating %s zeroed disk %s", mode, outputf)
+        # truncating first guarantees that no previous content survives
+        with open(outputf, 'wb') as diskf:
+            if mode == 'preallocate':
+                try:
+                    os.posix_fallocate(diskf.fileno(), 0, size)
+                    return
+                except OSError as error:
+                    logging.warning("fallocate not supported (%s), fall back to sparse file",
+                                    error)
+            diskf.truncate(size)
+
+FICLONE = 0x40049409
+
+def clone_file(source, destination):
+    """
+        Copy a file, sharing its blocks (reflink) when the filesystem supports it.
+        Otherwise only its data segments are copied (copy_file_range when available)
+        so that the holes of a sparse file stay holes.
+        Return the method used: 'reflink' or 'copy'.
+    """
+    with open(source, 'rb') as sourcef, open(destination, 'wb') as destinationf:
+        try:
+            fcntl.ioctl(destinationf.fileno(), FICLONE, sourcef.fileno())
+            return 'reflink'
+        except (IOError, OSError) as error:
+            if error.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                                   errno.ENOTTY, errno.EBADF):
+                raise
+        size = os.fstat(sourcef.fileno()).st_size
+        destinationf.truncate(size)
+        copy_sparse(sourcef.fileno(), destinationf.fileno(), 0, size)
+    return 'copy'
+
+def data_segments(fd, size, start=0):
+    """
+        Yield the (offset, length) of the data segments of a file between start
+        and size, skipping its holes. Without hole support, it is all data.
+    """
+    offset = start
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                return
+            if error.errno != errno.EINVAL or offset != start:
+                raise
+            yield start, size - start
+            return
+        if data >= size:
+            return
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+        yield data, hole - data
+        offset = hole
+
+def copy_sparse(source_fd, destination_fd, offset, length, destination_offset=None,
+                chunk=COPY_CHUNK):
+    """
+        Copy the data segments of length bytes at offset in source to
+        destination_offset (offset by default) in destination, whose holes
+        must already read as zeros. Return the number of bytes copied.
+    """
+    if destination_offset is None:
+        destination_offset = offset
+    copied = 0
+    for data, size in data_segments(source_fd, offset + length, offset):
+        copied += _copy_range(source_fd, destination_fd, data, size,
+                              destination_offset + data - offset, chunk)
+    return copied
+
+def _copy_range(source_fd, destination_fd, offset, length, destination_offset=None,
+                chunk=COPY_CHUNK):
+    """
+        Copy length bytes at offset in source to destination_offset (offset by
+        default) in destination: copy_file_range, else sendfile, else through
+        a buffer of chunk bytes. Return the number of bytes copied.
+    """
+    if destination_offset is None:
+        destination_offset = offset
+    kernel_copy = hasattr(os, 'copy_file_range')
+    sendfile = hasattr(os, 'sendfile')
+    done = 0
+    while done < length:
+        count = min(length - done, chunk)
+        copied = 0
+        if kernel_copy:
+            try:
+                copied = os.copy_file_range(source_fd, destination_fd, count,
+                                            offset + done, destination_offset + done)
+            except OSError as error:
+                if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+                                       errno.EINVAL):
+                    raise
+                kernel_copy = False
+        if not copied and sendfile:
+            try:
+                os.lseek(destination_fd, destination_offset + done, os.SEEK_SET)
+                copied = os.sendfile(destination_fd, source_fd, offset + done, count)
+            except OSError as error:
+                if error.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                sendfile = False
+        if not copied:
+            data = os.pread(source_fd, count, offset + done)
+            if not data:
+                break
+            copied = os.pwrite(destination_fd, data, destination_offset + done)
+        done += copied
+        metrics.add_bytes(copied)
+    return done
+
+class Qcow2Writer(object):
+    """
+        Write a raw disk image into a qcow2 (version 2) container.
+        Only the clusters holding data are stored, optionally compressed
+        (deflate) when it makes them smaller. Clusters which are not written
+        are read from the backing file, if any.
+    """
+    MAGIC = b'QFI\xfb'
+    _HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+    _EXTENSION = struct.Struct('>II')
+    _BACKING_FORMAT = 0xE2792ACA
+    _COPIED = 1 << 63
+    _COMPRESSED = 1 << 62
+
+    def __init__(self, destination, size, cluster_bits=16, compress=False,
+                 backing_file=None, backing_format=None):
+        self._destination = destination
+        self._size = size
+        self._backing_file = backing_file
+        self._backing_format = backing_format
+        self._cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self._compress = compress
+        self._l2_entries = self.cluster_size // 8
+        self._clusters = -(-size // self.cluster_size)
+        self._l1_size = -(-self._clusters // self._l2_entries)
+        self._l1_clusters = max(1, -(-self._l1_size * 8 // self.cluster_size))
+        self._l2_tables = dict()
+        self._refcounts = dict()
+        self._file = None
+        self._end = 0
+
+    def __enter__(self):
+        self._file = open(self._destination, 'wb')
+        # the header and the L1 table come first, the data next
+        self._end = (1 + self._l1_clusters) * self.cluster_size
+        for cluster in range(1 + self._l1_clusters):
+            self._refcounts[cluster] = 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._finish()
+        finally:
+            self._file.close()
+
+    def _append_cluster(self, references=1):
+        offset = -(-self._end // self.cluster_size) * self.cluster_size
+        self._refcounts[offset >> self._cluster_bits] = references
+        self._end = offset + self.cluster_size
+        return offset
+
+    def _write_at(self, offset, data):
+        self._file.seek(offset)
+        self._file.write(data)
+        metrics.add_bytes(len(data))
+
+    def _set_l2(self, cluster, entry):
+        index = cluster // self._l2_entries
+        if index not in self._l2_tables:
+            self._l2_tables[index] = array.array('Q', bytes(self.cluster_size))
+        self._l2_tables[index][cluster % self._l2_entries] = entry
+
+    def write_cluster(self, cluster, data):
+        """
+            Store the guest cluster of the given index (data is zero padded)
+        """
+        if self._compress:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -12)
+            padded = bytes(data) + bytes(self.cluster_size - len(data))
+            compressed = compressor.compress(padded) + compressor.flush()
+            if len(compressed) < self.cluster_size - 512:
+                self._write_compressed(cluster, compressed)
+                return
+        offset = self._append_cluster()
+        self._write_at(offset, data)
+        self._set_l2(cluster, offset | self._COPIED)
+
+    def _write_compressed(self, cluster, compressed):
+        offset = self._end
+        # compressed data never spans two host clusters
+        if (offset & (self.cluster_size - 1)) + len(compressed) > self.cluster_size \
+                or offset & (self.cluster_size - 1) == 0:
+            offset = self._append_cluster(references=0)
+        self._end = offset + len(compressed)
+        self._refcounts[offset >> self._cluster_bits] += 1
+        self._write_at(offset, compressed)
+        sectors = ((offset + len(compressed) - 1) >> 9) - (offset >> 9)
+        shift = 62 - (self._cluster_bits - 8)
+        self._set_l2(cluster, self._COMPRESSED | (sectors << shift) | offset)
+
+    def _finish(self):
+        l1_table = array.array('Q', bytes(self._l1_clusters * self.cluster_size))
+        for index in sorted(self._l2_tables):
+            offset = self._append_cluster()
+            self._write_at(offset, self._big_endian(self._l2_tables[index]))
+            l1_table[index] = offset | self._COPIED
+        self._write_at(self.cluster_size, self._big_endian(l1_table))
+
+        # the refcount blocks also count themselves and the refcount table
+        per_block = self.cluster_size // 2
+        first = -(-self._end // self.cluster_size)
+        table_clusters, blocks = 1, 1
+        while True:
+            needed_blocks = -(-(first + table_clusters + blocks) // per_block)
+            needed_table = -(-needed_blocks * 8 // self.cluster_size)
+            if needed_blocks <= blocks and needed_table <= table_clusters:
+                break
+            blocks = max(blocks, needed_blocks)
+            table_clusters = max(table_clusters, needed_table)
+        table_offset = first * self.cluster_size
+        for cluster in range(first, first + table_clusters + blocks):
+            self._refcounts[cluster] = 1
+        refcount_table = array.array('Q', bytes(table_clusters * self.cluster_size))
+        for block in range(blocks):
+            offset = (first + table_clusters + block) * self.cluster_size
+            refcounts = array.array('H', bytes(self.cluster_size))
+            for cluster in range(block * per_block, (block + 1) * per_block):
+                refcounts[cluster - block * per_block] = self._refcounts.get(cluster, 0)
+            self._write_at(offset, self._big_endian(refcounts))
+            refcount_table[block] = offset
+        self._write_at(table_offset, self._big_endian(refcount_table))
+
+        # header extensions, then the name of the backing file
+        extensions = b''
+        if self._backing_format:
+            data = self._backing_format.encode()
+            extensions += self._EXTENSION.pack(self._BACKING_FORMAT, len(data)) \
+                + data + bytes(-len(data) % 8)
+        extensions += self._EXTENSION.pack(0, 0)
+        backing_file = os.fsencode(self._backing_file) if self._backing_file else b''
+        backing_offset = self._HEADER.size + len(extensions) if backing_file else 0
+        if self._HEADER.size + len(extensions) + len(backing_file) > self.cluster_size:
+            raise ValueError("backing file name too long: {}".format(self._backing_file))
+        self._write_at(0, self._HEADER.pack(self.MAGIC, 2, backing_offset, len(backing_file),
+                                            self._cluster_bits, self._size, 0, self._l1_size,
+                                            self.cluster_size, table_offset, table_clusters,
+                                            0, 0) + extensions + backing_file)
+        self._file.truncate((first + table_clusters + blocks) * self.cluster_size)
+
+    @staticmethod
+    def _big_endian(table):
+        table = array.array(table.typecode, table)
+        if sys.byteorder == 'little':
+            table.byteswap()
+        return table.tobytes()
+
+def create_overlay(backing_file, destination):
+    """
+        Create an empty qcow2 image on top of a raw or qcow2 disk image:
+        reads go to the backing file, writes stay in the overlay
+    """
+    backing_file = os.path.abspath(backing_file)
+    with open(backing_file, 'rb') as backingf:
+        header = backingf.read(Qcow2Writer._HEADER.size)
+    if header.startswith(Qcow2Writer.MAGIC):
+        backing_format = 'qcow2'
+        size = Qcow2Writer._HEADER.unpack(header)[5]
+    else:
+        backing_format = 'raw'
+        size = os.path.getsize(backing_file)
+    with Qcow2Writer(destination, size, backing_file=backing_file,
+                     backing_format=backing_format):
+        pass
+
+def convert_qcow2(source, destination, compress=False):
+    """
+        Convert a raw disk image into a qcow2 image holding only its non-zero clusters
+    """
+    with metrics.stage('convert', format='qcow2', compress=compress):
+        logging.info("converting %s to qcow2 %s", source, destination)
+        size = os.path.getsize(source)
+        temporary = '{}.{}.tmp'.format(destination, os.getpid())
+        try:
+            with open(source, 'rb') as sourcef, \
+                    Qcow2Writer(temporary, size, compress=compress) as writer:
+                cluster_size = writer.cluster_size
+                buffer = bytearray(cluster_size)
+                zero = bytes(cluster_size)
+                # segments are sorted, a cluster shared by two segments is read once
+                next_cluster = 0
+                for offset, length in data_segments(sourcef.fileno(), size):
+                    first = max(offset // cluster_size, next_cluster)
+                    next_cluster = -(-(offset + length) // cluster_size)
+                    for cluster in range(first, next_cluster):
+                        sourcef.seek(cluster * cluster_size)
+                        count = sourcef.readinto(buffer)
+                        data = memoryview(buffer)[:count]
+                        if data != zero[:count]:
+                            writer.write_cluster(cluster, data)
+            os.rename(temporary, destination)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
 
 class Mtools(object):
     """
-        Mtools context manager
+        Mtools context manager working on a partition of a disk image,
+        addressed by its byte offset (no temporary partition file).
+        Every command is batched into a single mtools invocation.
     """
 
-    def __init__(self, disk):
-        self._disk = disk
+    def __init__(self, disk, offset=0, sectors=None, timestamp=None):
+        self._image = '{}@@{}'.format(disk, offset) if offset else disk
+        self._offset = offset
+        self._sectors = sectors
+        self._env = dict(os.environ, MTOOLS_SKIP_CHECK='1')
+        # mcopy keeps the modification time of the files (-m), unless every
+        # entry is dated with SOURCE_DATE_EPOCH
+        self._mcopy_options = ['-m']
+        if timestamp is not None:
+            self._env['SOURCE_DATE_EPOCH'] = str(timestamp)
+            self._mcopy_options = list()
 
     def __enter__(self):
         return self
@@ -67,56 +600,62 @@ class Mtools(object):
     def __exit__(self, *exc):
         return
 
-    def format(self):
+    def _run(self, command, *arguments):
+        args = [command, '-i', self._image]
+        args.extend(arguments)
+        check_output(args, env=self._env)
+
+    @staticmethod
+    def _fatpath(fatpath):
+        if fatpath.startswith('::'):
+            return fatpath
+        return '::/' + fatpath.lstrip('/')
+
+    def format(self, volume_id=None):
         """
-            Format the disk in FAT32
+            Format the partition in FAT32
         """
         logging.info("mformat: format to FAT32")
-        args = list()
-        args.append('mformat')
-        args.append('-F')
-        args.extend(['-i', self._disk])
-        args.extend(['-h', '5'])
-        args.extend(['-t', '255'])
+        args = ['-F']
+        if volume_id is not None:
+            args.extend(['-N', '{:08x}'.format(volume_id)])
+        sectors_per_cluster = 1
+        if self._sectors is not None:
+            args.extend(['-T', str(self._sectors)])
+            args.extend(['-H', str(self._offset // 512)])
+            sectors_per_cluster = Fat32.default_sectors_per_cluster(self._sectors)
+        args.extend(['-h', '255'])
         args.extend(['-s', '63'])
-        args.extend(['-c', '1'])
-        subprocess.check_output(args)
+        args.extend(['-c', str(sectors_per_cluster)])
+        self._run('mformat', *args)
 
-    def copy(self, syspath, fatpath='::'):
+    def mkdirs(self, fatpaths):
         """
-            Copy a file or directory to the given FAT path ('/' by default)
+            Create the given directories, parents first, existing ones are kept
         """
-        if os.path.isdir(syspath):
-            self._copydir(syspath, fatpath)
-        else:
-            self._copyfile(syspath, fatpath)
+        if not fatpaths:
+            return
+        logging.info("mmd: create %d directories", len(fatpaths))
+        self._run('mmd', '-D', 's', *[self._fatpath(path) for path in sorted(fatpaths)])
 
-    def _copyfile(self, filepath, fatpath='::'):
-        logging.info("mcopy: copy %s to %s", filepath, fatpath)
-        args = list()
-        args.append('mcopy')
-        args.extend(['-i', self._disk])
-        args.append(filepath)
-        args.append(fatpath)
-        subprocess.check_output(args)
-
-    def _copydir(self, dirpath, fatpath='::'):
-        # Not sure how it works here
-        # Investigate and test in the future
-        basedir = os.path.basename(dirpath)
-        self._mkdir(basedir, fatpath)
-        for root, dirs, files in os.walk(dirpath):
-            for name in files:
-                self._copyfile(name, fatpath + '/' + basedir)
-
-    def _mkdir(self, dirname, fatpath='::'):
-        logging.info("mmd: create %s in %s", dirname, fatpath)
-        args = list()
-        args.append('mmd')
-        args.extend(['-i', self._disk])
-        args.append(dirname)
-        args.append(fatpath)
-        subprocess.check_output(args)
+    def remove(self, fatpaths):
+        """
+            Remove the given files
+        """
+        if not fatpaths:
+            return
+        logging.info("mdel: remove %d files", len(fatpaths))
+        self._run('mdel', *[self._fatpath(path) for path in fatpaths])
+
+    def copy(self, syspaths, fatpath='::'):
+        """
+            Copy files or directories (recursively) to the given FAT directory ('/' by default)
+        """
+        if not syspaths:
+            return
+        logging.info("mcopy: copy %d files or directories to %s", len(syspaths), fatpath)
+        self._run('mcopy', '-s', '-D', 'o', *(self._mcopy_options + list(syspaths)
+                                              + [self._fatpath(fatpath).rstrip('/') + '/']))
 
 
 class Parted(object):
@@ -129,10 +668,15 @@ class Parted(object):
         self._child = None
 
     def __enter__(self):
+        if pexpect is None:
+            raise EnvironmentError("pexpect is required to drive parted")
+        metrics.add_subprocess()
         self._child = pexpect.spawn(command='parted',
                                     args=[self._disk],
                                     encoding='utf-8')
-        self._child.logfile_read = sys.stdout
+        # the raw session is only echoed when debugging
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self._child.logfile_read = sys.stdout
         return self
 
     def __exit__(self, *exc):
@@ -151,13 +695,15 @@ class Parted(object):
         self._child.expect(r"^Yes/No? ")
         self._child.sendline('Y')
 
-    def cmd_newpartition(self, guid):
+    def cmd_newpartition(self, guid, first_lba=2048, last_lba=None):
         """
-            Create a new bootable FAT32 partition
+            Create a new bootable FAT32 partition, up to the last usable sector by default
         """
-        logging.info("gdisk: create new EFI partition")
+        logging.info("parted: create new EFI partition")
         self._child.expect(r"^(parted) ")
-        self._child.sendline('mkpart {guid} FAT32 2048s 93716s'.format(guid=guid))
+        self._child.sendline('mkpart {guid} FAT32 {first}s {last}s'
+                             .format(guid=guid, first=first_lba,
+                                     last=-34 if last_lba is None else last_lba))
         self._child.expect(r"^(parted) ")
         self._child.sendline('toggle 1 boot')
 
@@ -183,15 +729,21 @@ class Gdisk(object):
         'EFI': 'ef00'
     }
 
-    def __init__(self, disk):
+    def __init__(self, disk, seed=None):
         self._disk = disk
+        self._seed = seed
         self._child = None
 
     def __enter__(self):
+        if pexpect is None:
+            raise EnvironmentError("pexpect is required to drive gdisk")
+        metrics.add_subprocess()
         self._child = pexpect.spawn(command='gdisk',
                                     args=[self._disk],
                                     encoding='utf-8')
-        self._child.logfile_read = sys.stdout
+        # the raw session is only echoed when debugging
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self._child.logfile_read = sys.stdout
         return self
 
     def __exit__(self, *exc):
@@ -208,9 +760,10 @@ class Gdisk(object):
         self._child.expect(r"^.*\(Y/N\): ")
         self._child.sendline('Y')
 
-    def cmd_newpartition(self, guid):
+    def cmd_newpartition(self, guid, first_lba=None, last_lba=None):
         """
-            Create a new bootable FAT32 partition
+            Create a new bootable FAT32 partition, gdisk's defaults are used
+            for the bounds which are not given
         """
         logging.info("gdisk: create new EFI partition")
         self._child.expect(r"Command \(\? for help\): ")
@@ -218,9 +771,9 @@ class Gdisk(object):
         self._child.expect(r"Partition number .*, default .*\): ")
         self._child.sendline()
         self._child.expect(r"size\{KMGTP\}: ")
-        self._child.sendline()
+        self._child.sendline('' if first_lba is None else str(first_lba))
         self._child.expect(r"size\{KMGTP\}: ")
-        self._child.sendline()
+        self._child.sendline('' if last_lba is None else str(last_lba))
         self._child.expect(r"Hex code or GUID.*\): ")
         self._child.sendline(self.__partition_guids[guid])
 
@@ -237,47 +790,767 @@ class Gdisk(object):
         """
         logging.info("gdisk: write table to disk")
         self._child.expect(r"Command \(\? for help\): ")
+        if self._seed is not None:
+            # replace the random GUIDs in the expert menu, which can write the table too
+            self._child.sendline('x')
+            self._child.expect(r"Expert command \(\? for help\): ")
+            self._child.sendline('g')
+            self._child.expect(r"GUID \('R' to randomize\): ")
+            self._child.sendline(str(seeded_guid(self._seed, 'disk')))
+            self._child.expect(r"Expert command \(\? for help\): ")
+            self._child.sendline('c')
+            self._child.expect(r"GUID \('R' to randomize\): ")
+            self._child.sendline(str(seeded_guid(self._seed, 'partition-1')))
+            self._child.expect(r"Expert command \(\? for help\): ")
         self._child.sendline('w')
         self._child.expect(r"^.*\(Y/N\): ")
         self._child.sendline('Y')
 
 
+EFI_SYSTEM_PARTITION = uuid.UUID('C12A7328-F81F-11D2-BA4B-00A0C93EC93B')
+
+GptPartition = namedtuple('GptPartition', ['type_guid', 'guid', 'first_lba', 'last_lba', 'name'])
+
+class GptWriter(object):
+    """
+        Context manager writing a GUID partition table (GPT) straight into a disk image.
+        It offers the same commands as Gdisk without spawning any process:
+            - create a GPT (protective MBR, primary and backup headers)
+            - create a partition of a given type
+            - list the partitions
+            - apply changes on disk
+    """
+
+    __partition_guids = {
+        'EFI': EFI_SYSTEM_PARTITION
+    }
+    __partition_names = {
+        'EFI': 'EFI System'
+    }
+
+    _HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+    _ENTRY = struct.Struct('<16s16sQQQ72s')
+    _SIGNATURE = b'EFI PART'
+    _REVISION = 0x00010000
+    _ENTRIES_COUNT = 128
+    _ALIGNMENT = 2048
+
+    def __init__(self, disk, sector_size=512, seed=None):
+        self._disk = disk
+        self._sector_size = sector_size
+        self._seed = seed
+        self._file = None
+        self._sectors = 0
+        self._disk_guid = None
+        self._partitions = list()
+
+    def __enter__(self):
+        self._file = open(self._disk, 'r+b')
+        self._sectors = os.fstat(self._file.fileno()).st_size // self._sector_size
+        if self._sectors <= 2 * self._table_sectors() + 2:
+            raise ValueError("{disk} is too small to hold a GPT".format(disk=self._disk))
+        return self
+
+    def __exit__(self, *exc):
+        self._file.close()
+        self._file = None
+
+    @property
+    def partitions(self):
+        """
+            Partitions planned so far
+        """
+        return list(self._partitions)
+
+    def _table_sectors(self):
+        return self._ENTRIES_COUNT * self._ENTRY.size // self._sector_size
+
+    def _first_usable_lba(self):
+        return 2 + self._table_sectors()
+
+    def _last_usable_lba(self):
+        return self._sectors - 2 - self._table_sectors()
+
+    def cmd_newtable(self):
+        """
+            Create a new Global Partition Table
+        """
+        logging.info("gpt: create new GPT")
+        self._disk_guid = seeded_guid(self._seed, 'disk')
+        self._partitions = list()
+
+    def cmd_newpartition(self, guid, first_lba=None, last_lba=None):
+        """
+            Create a new bootable FAT32 partition.
+            By default, it starts on the first aligned sector after the last
+            partition and spans the largest available space.
+        """
+        logging.info("gpt: create new EFI partition")
+        if len(self._partitions) == self._ENTRIES_COUNT:
+            raise ValueError("no partition entry left in the GPT")
+        if first_lba is None:
+            first_lba = self._first_usable_lba()
+            if self._partitions:
+                first_lba = self._partitions[-1].last_lba + 1
+            first_lba = -(-first_lba // self._ALIGNMENT) * self._ALIGNMENT
+        if last_lba is None:
+            last_lba = self._last_usable_lba()
+        if not self._first_usable_lba() <= first_lba <= last_lba <= self._last_usable_lba():
+            raise ValueError("partition [{}, {}] out of usable sectors [{}, {}]"
+                             .format(first_lba, last_lba,
+                                     self._first_usable_lba(), self._last_usable_lba()))
+        for partition in self._partitions:
+            if first_lba <= partition.last_lba and partition.first_lba <= last_lba:
+                raise ValueError("partition [{}, {}] overlaps [{}, {}]"
+                                 .format(first_lba, last_lba,
+                                         partition.first_lba, partition.last_lba))
+        name = 'partition-{}'.format(len(self._partitions) + 1)
+        self._partitions.append(GptPartition(self.__partition_guids[guid],
+                                             seeded_guid(self._seed, name),
+                                             first_lba,
+                                             last_lba,
+                                             self.__partition_names[guid]))
+
+    def cmd_printtable(self):
+        """
+            Print the partition table
+        """
+        logging.info("gpt: disk %s: %d sectors, disk identifier (GUID): %s",
+                     self._disk, self._sectors, self._disk_guid)
+        for number, partition in enumerate(self._partitions, start=1):
+            logging.info("\t%d: %d-%d (%d sectors) type %s, name '%s'",
+                         number, partition.first_lba, partition.last_lba,
+                         partition.last_lba - partition.first_lba + 1,
+                         partition.type_guid, partition.name)
+
+    def _entries(self):
+        entries = bytearray(self._ENTRIES_COUNT * self._ENTRY.size)
+        for index, partition in enumerate(self._partitions):
+            self._ENTRY.pack_into(entries, index * self._ENTRY.size,
+                                  partition.type_guid.bytes_le,
+                                  partition.guid.bytes_le,
+                                  partition.first_lba,
+                                  partition.last_lba,
+                                  0,
+                                  partition.name.encode('utf-16-le'))
+        return bytes(entries)
+
+    def _header(self, current_lba, backup_lba, entries_lba, entries_crc):
+        fields = [self._SIGNATURE, self._REVISION, self._HEADER.size, 0, 0,
+                  current_lba, backup_lba,
+                  self._first_usable_lba(), self._last_usable_lba(),
+                  self._disk_guid.bytes_le, entries_lba,
+                  self._ENTRIES_COUNT, self._ENTRY.size, entries_crc]
+        fields[3] = zlib.crc32(self._HEADER.pack(*fields)) & 0xffffffff
+        header = self._HEADER.pack(*fields)
+        return header + bytes(self._sector_size - len(header))
+
+    def _protective_mbr(self):
+        mbr = bytearray(self._sector_size)
+        struct.pack_into('<B3sB3sII', mbr, 446,
+                         0x00, b'\x00\x02\x00',
+                         0xee, b'\xff\xff\xff',
+                         1, min(self._sectors - 1, 0xffffffff))
+        mbr[510:512] = b'\x55\xaa'
+        return bytes(mbr)
+
+    def _write_at(self, lba, data):
+        self._file.seek(lba * self._sector_size)
+        self._file.write(data)
+        metrics.add_bytes(len(data))
+
+    def cmd_writetable(self):
+        """
+            Apply the planned changes to the partition table
+        """
+        logging.info("gpt: write table to disk")
+        if self._disk_guid is None:
+            raise ValueError("no GPT to write, create one first")
+        entries = self._entries()
+        entries_crc = zlib.crc32(entries) & 0xffffffff
+        last_lba = self._sectors - 1
+        backup_entries_lba = last_lba - self._table_sectors()
+        self._write_at(0, self._protective_mbr())
+        self._write_at(1, self._header(1, last_lba, 2, entries_crc))
+        self._write_at(2, entries)
+        self._write_at(backup_entries_lba, entries)
+        self._write_at(last_lba, self._header(last_lba, 1, backup_entries_lba, entries_crc))
+        self._file.flush()
+
+
+def read_gpt(disk, sector_size=512):
+    """
+        Read the partitions from the primary GPT of a disk image
+    """
+    header_struct = GptWriter._HEADER
+    entry_struct = GptWriter._ENTRY
+    with open(disk, 'rb') as diskf:
+        diskf.seek(sector_size)
+        header = diskf.read(header_struct.size)
+        fields = list(header_struct.unpack(header))
+        if fields[0] != GptWriter._SIGNATURE:
+            raise ValueError("{disk} has no GPT".format(disk=disk))
+        header_crc = fields[3]
+        fields[3] = 0
+        if zlib.crc32(header_struct.pack(*fields)) & 0xffffffff != header_crc:
+            raise ValueError("{disk}: corrupted GPT header".format(disk=disk))
+        entries_lba, entries_count, entry_size, entries_crc = fields[10:14]
+        diskf.seek(entries_lba * sector_size)
+        entries = diskf.read(entries_count * entry_size)
+    if zlib.crc32(entries) & 0xffffffff != entries_crc:
+        raise ValueError("{disk}: corrupted GPT entries".format(disk=disk))
+    partitions = list()
+    for offset in range(0, len(entries), entry_size):
+        type_guid, guid, first_lba, last_lba, _, name = \
+            entry_struct.unpack_from(entries, offset)
+        if type_guid == bytes(16):
+            continue
+        partitions.append(GptPartition(uuid.UUID(bytes_le=type_guid),
+                                       uuid.UUID(bytes_le=guid),
+                                       first_lba,
+                                       last_lba,
+                                       name.decode('utf-16-le').rstrip('\x00')))
+    return partitions
+
+
+FatEntry = namedtuple('FatEntry', ['name', 'short_name', 'attributes', 'cluster', 'size', 'slots'])
+
+class Fat32(object):
+    """
+        FAT32 context manager working directly inside a disk image.
+        The partition is accessed through a memory-mapped window at its LBA
+        offset, the FAT is kept in memory and only the touched sectors are
+        written back. Propose the following features:
+            - format the partition in FAT32
+            - create directories
+            - write files
+            - remove files
+        Every entry is dated with timestamp when it is given (UTC), with the
+        modification time of its file otherwise.
+    """
+
+    _BOOT_SECTOR = struct.Struct('<3s8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s')
+    _DIR_ENTRY = struct.Struct('<11sBBBHHHHHHHI')
+    _LFN_ENTRY = struct.Struct('<B10sBBB12sH4s')
+
+    _RESERVED_SECTORS = 32
+    _FATS = 2
+    _MEDIA = 0xf8
+    _MIN_CLUSTERS = 65525
+    _END_OF_CHAIN = 0x0fffffff
+    _CLUSTER_MASK = 0x0fffffff
+
+    _ATTR_DIRECTORY = 0x10
+    _ATTR_ARCHIVE = 0x20
+    _ATTR_LFN = 0x0f
+    _FREE_SLOT = 0xe5
+    _SHORTNAME_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$%\'-_@~`!(){}^#&')
+
+    def __init__(self, disk, first_lba, sectors, sector_size=512, timestamp=None):
+        self._disk = disk
+        self._first_lba = first_lba
+        self._sectors = sectors
+        self._sector_size = sector_size
+        self._fixed_timestamp = timestamp
+        self._file = None
+        self._map = None
+        self._base = 0
+        self._fat = None
+        self._dirty_fat_sectors = set()
+        self._listings = dict()
+
+    def __enter__(self):
+        offset = self._first_lba * self._sector_size
+        aligned_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self._base = offset - aligned_offset
+        self._file = open(self._disk, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(),
+                              self._base + self._sectors * self._sector_size,
+                              offset=aligned_offset)
+        if self._map[self._base + 510:self._base + 512] == b'\x55\xaa' \
+                and self._map[self._base + 82:self._base + 90] == b'FAT32   ':
+            self._load()
+        return self
+
+    def __exit__(self, *exc):
+        if self._fat is not None:
+            self._flush()
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+        self._map = None
+        self._file = None
+
+    # geometry
+
+    @staticmethod
+    def default_sectors_per_cluster(sectors, sector_size=512):
+        """
+            Cluster size of a partition, as recommended by Microsoft
+        """
+        size = sectors * sector_size
+        for limit, cluster_size in ((260 << 20, 512), (8 << 30, 4096),
+                                    (16 << 30, 8192), (32 << 30, 16384)):
+            if size <= limit:
+                return max(cluster_size // sector_size, 1)
+        return max(32768 // sector_size, 1)
+
+    @classmethod
+    def geometry(cls, sectors, sectors_per_cluster):
+        """
+            Return the size of each FAT (in sectors) and the number of clusters
+            of a partition formatted with the given cluster size
+        """
+        available = sectors - cls._RESERVED_SECTORS
+        fat_sectors = -(-available // ((256 * sectors_per_cluster + cls._FATS) // 2))
+        clusters = (available - cls._FATS * fat_sectors) // sectors_per_cluster
+        return fat_sectors, clusters
+
+    def _sector(self, sector):
+        return self._base + sector * self._sector_size
+
+    def _cluster_offset(self, cluster):
+        return self._sector(self._data_sector + (cluster - 2) * self._sectors_per_cluster)
+
+    def _write(self, offset, data):
+        self._map[offset:offset + len(data)] = data
+        metrics.add_bytes(len(data))
+
+    def _zero(self, offset, length):
+        # only write chunks holding data so that holes of a sparse image stay holes
+        chunk_size = 1 << 16
+        zeros = bytes(chunk_size)
+        end = offset + length
+        while offset < end:
+            size = min(chunk_size, end - offset)
+            if self._map[offset:offset + size] != zeros[:size]:
+                self._write(offset, zeros[:size])
+            offset += size
+
+    # formatting
+
+    def format(self, sectors_per_cluster=None, volume_id=None, label='NO NAME'):
+        """
+            Format the partition in FAT32
+        """
+        logging.info("fat32: format %s at sector %d to FAT32", self._disk, self._first_lba)
+        if sectors_per_cluster is None:
+            sectors_per_cluster = self.default_sectors_per_cluster(self._sectors,
+                                                                   self._sector_size)
+        fat_sectors, clusters = self.geometry(self._sectors, sectors_per_cluster)
+        if clusters < self._MIN_CLUSTERS:
+            raise ValueError("partition too small for FAT32: {} clusters, {} required"
+                             .format(clusters, self._MIN_CLUSTERS))
+        if volume_id is None:
+            volume_id = uuid.uuid4().int & 0xffffffff
+
+        boot_sector = bytearray(self._sector_size)
+        self._BOOT_SECTOR.pack_into(boot_sector, 0,
+                                    b'\xeb\x58\x90', b'MSWIN4.1',
+                                    self._sector_size, sectors_per_cluster,
+                                    self._RESERVED_SECTORS, self._FATS,
+                                    0, 0, self._MEDIA, 0, 63, 255,
+                                    self._first_lba, self._sectors, fat_sectors,
+                                    0, 0, 2, 1, 6, bytes(12),
+                                    0x80, 0, 0x29, volume_id,
+                                    label.upper().ljust(11)[:11].encode('ascii'),
+                                    b'FAT32   ')
+        boot_sector[510:512] = b'\x55\xaa'
+        self._zero(self._sector(0), self._RESERVED_SECTORS * self._sector_size)
+        for sector in (0, 6):
+            self._write(self._sector(sector), boot_sector)
+        self._zero(self._sector(self._RESERVED_SECTORS),
+                   self._FATS * fat_sectors * self._sector_size)
+
+        self._sectors_per_cluster = sectors_per_cluster
+        self.cluster_size = sectors_per_cluster * self._sector_size
+        self._fat_sectors = fat_sectors
+        self._data_sector = self._RESERVED_SECTORS + self._FATS * fat_sectors
+        self._clusters = clusters
+        self._fat = array.array('I', bytes(4 * (clusters + 2)))
+        self._fat[0] = 0x0fffff00 | self._MEDIA
+        self._fat[1] = self._END_OF_CHAIN
+        self._free = clusters
+        self._next_free = 2
+        # the FAT region was zeroed above, only the first sector holds entries yet
+        self._dirty_fat_sectors = set([0])
+        self._listings = dict()
+        self._root_cluster = self._allocate(1)[0]
+        self._zero(self._cluster_offset(self._root_cluster), self.cluster_size)
+
+    def set_volume_id(self, volume_id):
+        """
+            Change the volume ID (serial number) of the formatted partition
+        """
+        for sector in (0, 6):
+            self._write(self._sector(sector) + 67, struct.pack('<I', volume_id))
+
+    def _load(self):
+        fields = self._BOOT_SECTOR.unpack_from(self._map, self._base)
+        if fields[2] != self._sector_size:
+            raise ValueError("unsupported FAT32 sector size: {}".format(fields[2]))
+        self._sectors_per_cluster = fields[3]
+        self.cluster_size = self._sectors_per_cluster * self._sector_size
+        self._fat_sectors = fields[14]
+        self._data_sector = fields[4] + fields[5] * self._fat_sectors
+        self._clusters = (fields[13] - self._data_sector) // self._sectors_per_cluster
+        self._root_cluster = fields[17]
+        fat_offset = self._sector(fields[4])
+        self._fat = array.array('I')
+        self._fat.frombytes(self._map[fat_offset:fat_offset + 4 * (self._clusters + 2)])
+        if sys.byteorder != 'little':
+            self._fat.byteswap()
+        self._free = self._fat.count(0)
+        self._next_free = 2
+        self._dirty_fat_sectors = set()
+
+    def _flush(self):
+        entries_per_sector = self._sector_size // 4
+        for fat_sector in sorted(self._dirty_fat_sectors):
+            entries = self._fat[fat_sector * entries_per_sector:
+                                (fat_sector + 1) * entries_per_sector]
+            if sys.byteorder != 'little':
+                entries.byteswap()
+            data = entries.tobytes()
+            data += bytes(self._sector_size - len(data))
+            for copy in range(self._FATS):
+                offset = self._sector(self._RESERVED_SECTORS
+                                      + copy * self._fat_sectors + fat_sector)
+                self._write(offset, data)
+        self._dirty_fat_sectors = set()
+        fsinfo = bytearray(self._sector_size)
+        struct.pack_into('<I', fsinfo, 0, 0x41615252)
+        struct.pack_into('<III', fsinfo, 484, 0x61417272, self._free, self._next_free)
+        struct.pack_into('<I', fsinfo, 508, 0xaa550000)
+        for sector in (1, 7):
+            self._write(self._sector(sector), fsinfo)
+
+    # cluster chains
+
+    def _set_fat(self, cluster, value):
+        self._fat[cluster] = (self._fat[cluster] & ~self._CLUSTER_MASK) | value
+        self._dirty_fat_sectors.add(cluster * 4 // self._sector_size)
+
+    def _allocate(self, count):
+        if count > self._free:
+            raise ValueError("no space left on the FAT32 partition")
+        clusters = list()
+        cluster = self._next_free
+        last = self._clusters + 2
+        while len(clusters) < count:
+            if cluster >= last:
+                cluster = 2
+            if not self._fat[cluster] & self._CLUSTER_MASK:
+                clusters.append(cluster)
+                self._fat[cluster] = self._END_OF_CHAIN
+            cluster += 1
+        for current, following in zip(clusters, clusters[1:] + [self._END_OF_CHAIN]):
+            self._set_fat(current, following)
+        self._free -= count
+        self._next_free = cluster if cluster < last else 2
+        return clusters
+
+    def _chain(self, cluster):
+        chain = list()
+        while 2 <= cluster < 0x0ffffff8:
+            chain.append(cluster)
+            cluster = self._fat[cluster] & self._CLUSTER_MASK
+        return chain
+
+    def _release(self, cluster):
+        for current in self._chain(cluster):
+            self._set_fat(current, 0)
+            self._free += 1
+
+    # directories
+
+    @staticmethod
+    def _split(fatpath):
+        if fatpath.startswith('::'):
+            fatpath = fatpath[2:]
+        return [part for part in fatpath.replace('\\', '/').split('/') if part]
+
+    def _entries(self, cluster):
+        """
+            List the entries of the directory starting at the given cluster
+        """
+        if cluster not in self._listings:
+            self._listings[cluster] = self._read_entries(cluster)
+        return self._listings[cluster]
+
+    def _read_entries(self, cluster):
+        entries = list()
+        long_name = list()
+        slots = 0
+        index = 0
+        for chain_cluster in self._chain(cluster):
+            offset = self._cluster_offset(chain_cluster)
+            for slot in range(self.cluster_size // self._DIR_ENTRY.size):
+                raw = self._map[offset:offset + self._DIR_ENTRY.size]
+                offset += self._DIR_ENTRY.size
+                index += 1
+                if raw[0] == 0:
+                    return entries
+                if raw[0] == self._FREE_SLOT:
+                    long_name, slots = list(), 0
+                    continue
+                if raw[11] == self._ATTR_LFN:
+                    fields = self._LFN_ENTRY.unpack(raw)
+                    long_name.insert(0, fields[1] + fields[5] + fields[7])
+                    slots += 1
+                    continue
+                fields = self._DIR_ENTRY.unpack(raw)
+                base = fields[0][:8].decode('ascii', 'replace').rstrip()
+                extension = fields[0][8:].decode('ascii', 'replace').rstrip()
+                short_name = base + ('.' + extension if extension else '')
+                name = short_name
+                if long_name:
+                    name = b''.join(long_name).decode('utf-16-le').split('\x00')[0]
+                entries.append(FatEntry(name, short_name, fields[1],
+                                        fields[7] << 16 | fields[10], fields[11],
+                                        list(range(index - slots - 1, index))))
+                long_name, slots = list(), 0
+        return entries
+
+    def _find(self, cluster, name):
+        for entry in self._entries(cluster):
+            if entry.name.upper() == name.upper() and entry.name not in ('.', '..'):
+                return entry
+        return None
+
+    def _slot_offset(self, chain, slot):
+        per_cluster = self.cluster_size // self._DIR_ENTRY.size
+        return self._cluster_offset(chain[slot // per_cluster]) \
+            + (slot % per_cluster) * self._DIR_ENTRY.size
+
+    def _free_slots(self, cluster, count):
+        """
+            Find (or make room for) count consecutive free slots in a directory
+        """
+        per_cluster = self.cluster_size // self._DIR_ENTRY.size
+        chain = self._chain(cluster)
+        run = list()
+        for slot in range(len(chain) * per_cluster):
+            first_byte = self._map[self._slot_offset(chain, slot)]
+            if first_byte in (0, self._FREE_SLOT):
+                run.append(slot)
+                if len(run) == count:
+                    return run
+            else:
+                run = list()
+        new_cluster = self._allocate(1)[0]
+        self._zero(self._cluster_offset(new_cluster), self.cluster_size)
+        self._set_fat(chain[-1], new_cluster)
+        first_slot = len(chain) * per_cluster
+        run.extend(range(first_slot, first_slot + count - len(run)))
+        return run
+
+    def _short_name(self, cluster, name):
+        """
+            Generate the 8.3 name of an entry and tell if a long name is needed
+        """
+        base, _, extension = name.rpartition('.') if '.' in name.lstrip('.') else (name, '', '')
+        short_base = ''.join(char if char in self._SHORTNAME_CHARS else '_'
+                             for char in base.upper().replace(' ', '').lstrip('.'))
+        short_extension = ''.join(char if char in self._SHORTNAME_CHARS else '_'
+                                  for char in extension.upper().replace(' ', ''))[:3]
+        if short_base == base and short_extension == extension and len(base) <= 8:
+            return (base.ljust(8) + extension.ljust(3)).encode('ascii'), False
+        existing = set(entry.short_name for entry in self._entries(cluster))
+        for number in range(1, 1000000):
+            tail = '~{}'.format(number)
+            candidate = short_base[:8 - len(tail)] + tail
+            if (candidate + ('.' + short_extension if short_extension else '')) not in existing:
+                return (candidate.ljust(8) + short_extension.ljust(3)).encode('ascii'), True
+        raise ValueError("cannot generate a short name for {}".format(name))
+
+    def _timestamp(self, seconds):
+        if self._fixed_timestamp is None:
+            stamp = time.localtime(seconds)
+        else:
+            stamp = time.gmtime(self._fixed_timestamp)
+        year = min(max(stamp.tm_year, 1980), 2107)
+        date = (year - 1980) << 9 | stamp.tm_mon << 5 | stamp.tm_mday
+        return date, stamp.tm_hour << 11 | stamp.tm_min << 5 | stamp.tm_sec // 2
+
+    def _add_entry(self, cluster, name, attributes, first_cluster, size, mtime):
+        short_name, needs_long_name = self._short_name(cluster, name)
+        long_entries = list()
+        if needs_long_name:
+            checksum = 0
+            for char in short_name:
+                checksum = (((checksum & 1) << 7) + (checksum >> 1) + char) & 0xff
+            encoded = name.encode('utf-16-le') + b'\x00\x00'
+            encoded += b'\xff' * (-len(encoded) % 26)
+            chunks = [encoded[start:start + 26] for start in range(0, len(encoded), 26)]
+            for order, chunk in enumerate(chunks, start=1):
+                if order == len(chunks):
+                    order |= 0x40
+                long_entries.insert(0, self._LFN_ENTRY.pack(order, chunk[:10], self._ATTR_LFN,
+                                                            0, checksum, chunk[10:22],
+                                                            0, chunk[22:26]))
+        date, clock = self._timestamp(mtime)
+        short_entry = self._DIR_ENTRY.pack(short_name, attributes, 0, 0, clock, date, date,
+                                           first_cluster >> 16, clock, date,
+                                           first_cluster & 0xffff, size)
+        slots = self._free_slots(cluster, len(long_entries) + 1)
+        chain = self._chain(cluster)
+        for slot, raw in zip(slots, long_entries + [short_entry]):
+            offset = self._slot_offset(chain, slot)
+            self._write(offset, raw)
+        self._listings.pop(cluster, None)
+
+    def _remove_entry(self, cluster, entry):
+        chain = self._chain(cluster)
+        for slot in entry.slots:
+            self._write(self._slot_offset(chain, slot), bytes([self._FREE_SLOT]))
+        self._listings.pop(cluster, None)
+        if entry.attributes & self._ATTR_DIRECTORY:
+            for child in list(self._entries(entry.cluster)):
+                if child.name not in ('.', '..'):
+                    self._remove_entry(entry.cluster, child)
+            self._listings.pop(entry.cluster, None)
+        self._release(entry.cluster)
+
+    def _directory(self, fatpath, create=False):
+        cluster = self._root_cluster
+        for name in self._split(fatpath):
+            entry = self._find(cluster, name)
+            if entry is None and create:
+                entry = self._mkdir(cluster, name)
+            if entry is None or not entry.attributes & self._ATTR_DIRECTORY:
+                raise ValueError("{} is not a directory".format(fatpath))
+            cluster = entry.cluster
+        return cluster
+
+    def _mkdir(self, parent, name, mtime=None):
+        if mtime is None:
+            mtime = time.time()
+        cluster = self._allocate(1)[0]
+        self._zero(self._cluster_offset(cluster), self.cluster_size)
+        date, clock = self._timestamp(mtime)
+        parent_cluster = 0 if parent == self._root_cluster else parent
+        offset = self._cluster_offset(cluster)
+        for dot_name, target in ((b'.', cluster), (b'..', parent_cluster)):
+            self._write(offset, self._DIR_ENTRY.pack(dot_name.ljust(11), self._ATTR_DIRECTORY,
+                                                     0, 0, clock, date, date, target >> 16,
+                                                     clock, date, target & 0xffff, 0))
+            offset += self._DIR_ENTRY.size
+        self._add_entry(parent, name, self._ATTR_DIRECTORY, cluster, 0, mtime)
+        return self._find(parent, name)
+
+    # public commands
+
+    def mkdir(self, fatpath):
+        """
+            Create a directory (and its parents) at the given FAT path
+        """
+        logging.info("fat32: create %s", fatpath)
+        self._directory(fatpath, create=True)
+
+    def remove(self, fatpath):
+        """
+            Remove a file or a directory from the given FAT path
+        """
+        parts = self._split(fatpath)
+        cluster = self._directory('/'.join(parts[:-1]))
+        entry = self._find(cluster, parts[-1])
+        if entry is not None:
+            logging.info("fat32: remove %s", fatpath)
+            self._remove_entry(cluster, entry)
+
+    def write_file(self, filepath, fatpath):
+        """
+            Write (or replace) a file at the given FAT path
+        """
+        logging.info("fat32: copy %s to %s", filepath, fatpath)
+        parts = self._split(fatpath)
+        cluster = self._directory('/'.join(parts[:-1]), create=True)
+        previous = self._find(cluster, parts[-1])
+        if previous is not None:
+            self._remove_entry(cluster, previous)
+        stat = os.stat(filepath)
+        size = stat.st_size
+        chain = self._allocate(-(-size // self.cluster_size)) if size else [0]
+        with open(filepath, 'rb') as source:
+            view = memoryview(self._map)
+            remaining = size
+            start = 0
+            while start < len(chain) and remaining:
+                # write runs of contiguous clusters at once
+                end = start + 1
+                while end < len(chain) and chain[end] == chain[end - 1] + 1:
+                    end += 1
+                offset = self._cluster_offset(chain[start])
+                length = min((end - start) * self.cluster_size, remaining)
+                source.readinto(view[offset:offset + length])
+                metrics.add_bytes(length)
+                self._zero(offset + length, -length % self.cluster_size)
+                remaining -= length
+                start = end
+            view.release()
+        self._add_entry(cluster, parts[-1], self._ATTR_ARCHIVE, chain[0], size, stat.st_mtime)
+
+
 class Losetup(object):
     """
-        Context manager to create a loopback device
+        Context manager to attach a disk image to a loopback device,
+        with its partitions
     """
 
-    def __init__(self, image):
+    def __init__(self, image, device=None):
         self._image = image
-        self._reserve_first_available()
+        self._loopback_dev = device
 
-    def _reserve_first_available(self):
+    def attach(self):
+        """
+            Attach the image to the first available device, return the device
+            and its partitions. Finding and attaching the device is atomic so
+            that concurrent builds do not race for the same device.
+        """
         args = list()
         args.append('losetup')
         args.append('--find')
-        self._loopback_dev = subprocess.check_output(args) \
-                                       .decode(sys.stdout.encoding) \
-                                       .replace(os.linesep, '')
-
-    def __enter__(self):
-        args = list()
-        args.append('losetup')
-        args.append(self._loopback_dev)
+        args.append('--show')
+        args.append('--partscan')
         args.append(self._image)
-        subprocess.check_output(args)
+        with metrics.stage('losetup', image=self._image):
+            self._loopback_dev = check_output(args) \
+                                           .decode(sys.stdout.encoding) \
+                                           .replace(os.linesep, '')
         logging.info("losetup: mount %s on %s", self._image, self._loopback_dev)
-        # check if partitions are available
+        return (self._loopback_dev, self.partitions())
+
+    def partitions(self):
+        """
+            List the partitions of the device, waiting for them to show up
+        """
+        deadline = time.time() + 5
         partitions = glob.glob(self._loopback_dev + 'p*')
+        while not partitions and time.time() < deadline:
+            time.sleep(0.05)
+            partitions = glob.glob(self._loopback_dev + 'p*')
+        partitions.sort()
         for partition in partitions:
             logging.info("\t- %s", partition)
-        return (self._loopback_dev, partitions)
+        return partitions
 
-    def __exit__(self, *exc):
+    def detach(self):
+        """
+            Detach the image from its device
+        """
         args = list()
         args.append('losetup')
         args.append('--detach')
         args.append(self._loopback_dev)
-        subprocess.check_output(args)
+        with metrics.stage('losetup-detach', device=self._loopback_dev):
+            check_output(args)
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
 
 class Mount(object):
     """
@@ -288,30 +1561,668 @@ class Mount(object):
     def __init__(self, device, directory=None):
         self._device = device
         self._mount_point = directory
-        self._is_tempdir = False
+        self._is_temp_dir = False
         if directory is None:
             self._mount_point = tempfile.mkdtemp(prefix='mountpoint')
             self._is_temp_dir = True
 
-    def __enter__(self):
+    def mount(self):
+        """
+            Mount the device, return the mount point
+        """
         args = list()
         args.append('mount')
         args.append(self._device)
         args.append(self._mount_point)
-        subprocess.check_output(args)
+        with metrics.stage('mount', device=self._device):
+            check_output(args)
         return self._mount_point
 
-    def __exit__(self, *exc):
+    def umount(self):
+        """
+            Unmount the device, the data is written back to it
+        """
         args = list()
         args.append('umount')
         args.append(self._mount_point)
-        subprocess.check_output(args)
+        with metrics.stage('umount', device=self._device):
+            check_output(args)
+
+    def __enter__(self):
+        return self.mount()
+
+    def __exit__(self, *exc):
+        self.umount()
         if self._is_temp_dir:
             os.rmdir(self._mount_point)
 
-def parse_args():
+class LoopSession(object):
+    """
+        Loopback device and mount point of a disk image kept across builds.
+        The session is stored next to the image, in the .cache directory.
+    """
+
+    def __init__(self, image):
+        # resolved like the backing file the kernel reports (symbolic links)
+        self._image = os.path.realpath(image)
+        self._path = os.path.join(os.path.dirname(os.path.abspath(image)), '.cache',
+                                  os.path.basename(image) + '.session.json')
+        self.device = None
+        self.partition = None
+        self.mount_point = None
+
+    @staticmethod
+    def _backing_file(device):
+        try:
+            with open('/sys/block/{}/loop/backing_file'.format(os.path.basename(device))) \
+                    as backingf:
+                return os.path.realpath(backingf.read().strip())
+        except (IOError, OSError):
+            return None
+
+    @property
+    def mounted(self):
+        """
+            True if the partition is mounted on the mount point of the session
+        """
+        if self.mount_point is None:
+            return False
+        with open('/proc/mounts') as mountsf:
+            return any(line.split()[:2] == [self.partition, self.mount_point]
+                       for line in mountsf)
+
+    def load(self):
+        """
+            Load the session, return False if the image has no live session.
+            What is left of a stale session is torn down.
+        """
+        try:
+            with open(self._path) as sessionf:
+                content = json.load(sessionf)
+            self.device = content['device']
+            self.partition = content['partition']
+            self.mount_point = content['mount_point']
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        if self._backing_file(self.device) == self._image:
+            logging.info("session: %s attached on %s, %s mounted on %s", self._image,
+                         self.device, self.partition, self.mount_point)
+            return True
+        logging.info("session: %s is no longer attached on %s", self._image, self.device)
+        self.device = None
+        self.stop()
+        return False
+
+    def save(self):
+        """
+            Write the session to disk
+        """
+        directory = os.path.dirname(self._path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self._path, 'w') as sessionf:
+            json.dump({'device': self.device,
+                       'partition': self.partition,
+                       'mount_point': self.mount_point}, sessionf, indent=2)
+
+    def start(self):
+        """
+            Attach the image, its partition is mounted by mount()
+        """
+        self.device, partitions = Losetup(self._image).attach()
+        if not partitions:
+            Losetup(self._image, self.device).detach()
+            raise EnvironmentError("{} has no partition".format(self.device))
+        self.partition = partitions[0]
+        self.mount_point = tempfile.mkdtemp(prefix='esp-')
+        self.save()
+
+    def mount(self):
+        """
+            Mount the partition
+        """
+        Mount(self.partition, self.mount_point).mount()
+
+    def unmount(self):
+        """
+            Unmount the partition
+        """
+        Mount(self.partition, self.mount_point).umount()
+
+    def stop(self):
+        """
+            Unmount the partition, detach the image and forget the session
+        """
+        if self.mounted:
+            self.unmount()
+        if self.device is not None and self._backing_file(self.device) == self._image:
+            Losetup(self._image, self.device).detach()
+        if self.mount_point is not None and os.path.isdir(self.mount_point):
+            os.rmdir(self.mount_point)
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self.device = None
+        self.partition = None
+        self.mount_point = None
+
+def list_payload(files):
+    """
+        List the payload as (system path, FAT path) pairs in copy order.
+        Directories are walked and placed at the root like 'cp -r' would do.
+    """
+    payload = list()
+    for name in files:
+        base = os.path.dirname(os.path.normpath(name))
+        if not os.path.isdir(name):
+            payload.append((name, os.path.basename(os.path.normpath(name))))
+            continue
+        for root, dirs, names in os.walk(name):
+            dirs.sort()
+            payload.append((root, os.path.relpath(root, base).replace(os.sep, '/')))
+            for filename in sorted(names):
+                syspath = os.path.join(root, filename)
+                payload.append((syspath, os.path.relpath(syspath, base).replace(os.sep, '/')))
+    return payload
+
+# tagged lines printed by the startup.nsh of a pack of tests
+PACK_RESULT = '@@TEST'
+PACK_DONE = '@@DONE'
+
+def pack_directory(output):
+    """
+        Directory where the payload of a pack of tests is laid out
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(output)), '.cache',
+                        os.path.basename(output) + '.pack')
+
+def pack_script(names):
+    """
+        Return a startup.nsh running every test of a pack from its own directory,
+        and printing its result then a final marker:
+            @@TEST <name> <%lasterror%>
+            @@DONE <number of tests>
+    """
+    lines = ['echo -off', '# generated by create_disk.py --pack', 'fs0:']
+    for name in names:
+        lines.append('cd \\tests\\{}'.format(name))
+        lines.append('{}.efi'.format(name))
+        lines.append('echo "{} {} %lasterror%"'.format(PACK_RESULT, name))
+    lines.append('cd \\')
+    lines.append('echo "{} {}"'.format(PACK_DONE, len(names)))
+    return '\n'.join(lines) + '\n'
+
+def pack_tests(output, tests):
+    """
+        Lay out the tests as tests/<name>/<name>.efi (symbolic links to the
+        tests) next to the generated startup.nsh
+    """
+    names = list()
+    for test in tests:
+        name, extension = os.path.splitext(os.path.basename(test))
+        if extension.lower() != '.efi':
+            raise ValueError("{} is not an EFI application".format(test))
+        if name in names:
+            raise ValueError("two tests are named {}".format(name))
+        names.append(name)
+    directory = pack_directory(output)
+    if os.path.isdir(os.path.join(directory, 'tests')):
+        shutil.rmtree(os.path.join(directory, 'tests'))
+    for name, test in zip(names, tests):
+        os.makedirs(os.path.join(directory, 'tests', name))
+        os.symlink(os.path.abspath(test), os.path.join(directory, 'tests', name, name + '.efi'))
+    script = pack_script(names)
+    path = os.path.join(directory, 'startup.nsh')
+    # an unchanged script is not copied again
+    if os.path.exists(path):
+        with open(path) as scriptf:
+            if scriptf.read() == script:
+                return
+    with open(path, 'w') as scriptf:
+        scriptf.write(script)
+
+def payload_files(args):
+    """
+        Files and directories copied at the root of the partition
+    """
+    if args.pack:
+        directory = pack_directory(args.output)
+        return [os.path.join(directory, 'tests'), os.path.join(directory, 'startup.nsh')]
+    return args.files
+
+Layout = namedtuple('Layout', ['disk_sectors', 'first_lba', 'last_lba', 'sectors_per_cluster'])
+
+ALIGNMENT = 2048 # sectors (1 MiB)
+GPT_BACKUP_SECTORS = 33 # backup partition entries and header
+
+def payload_clusters(payload, cluster_size):
+    """
+        Count the clusters needed by the payload: file data and directory entries
+    """
+    clusters = 0
+    slots = {'': 0}
+    for syspath, fatpath in payload:
+        parent = posixpath.dirname(fatpath)
+        # the short entry and the long name entries (13 characters each)
+        slots[parent] = slots.get(parent, 0) + 2 + len(posixpath.basename(fatpath)) // 13
+        if os.path.isdir(syspath):
+            slots.setdefault(fatpath, 2)
+        else:
+            clusters += -(-os.path.getsize(syspath) // cluster_size)
+    for count in slots.values():
+        clusters += max(1, -(-count * 32 // cluster_size))
+    return clusters
+
+def esp_sectors(clusters, sectors_per_cluster):
+    """
+        Smallest FAT32 partition (in sectors, aligned) holding the given clusters
+    """
+    clusters = max(clusters, Fat32._MIN_CLUSTERS)
+    sectors = Fat32._RESERVED_SECTORS + clusters * sectors_per_cluster
+    while True:
+        _, available = Fat32.geometry(sectors, sectors_per_cluster)
+        if available >= clusters:
+            break
+        sectors += (clusters - available) * sectors_per_cluster
+    return -(-sectors // ALIGNMENT) * ALIGNMENT
+
+def plan_layout(payload, disk_size=None, headroom=1 << 20, sector_size=512):
+    """
+        Compute the layout of a disk holding a single EFI system partition.
+        Without disk size (in bytes), the disk is the smallest one whose FAT32
+        partition holds the payload plus headroom bytes. Partition and disk
+        are aligned to 1 MiB.
+    """
+    def layout(disk_sectors, last_lba):
+        return Layout(disk_sectors, first_lba, last_lba,
+                      Fat32.default_sectors_per_cluster(last_lba - first_lba + 1, sector_size))
+
+    first_lba = ALIGNMENT
+    if disk_size is not None:
+        disk_sectors = disk_size // sector_size
+        last_lba = (disk_sectors - GPT_BACKUP_SECTORS) // ALIGNMENT * ALIGNMENT - 1
+        planned = layout(disk_sectors, last_lba)
+        _, clusters = Fat32.geometry(last_lba - first_lba + 1, planned.sectors_per_cluster)
+        if clusters < Fat32._MIN_CLUSTERS or not holds_payload(planned, payload, sector_size):
+            raise ValueError("a {} bytes disk cannot hold the payload in a FAT32 partition"
+                             .format(disk_size))
+        return planned
+
+    sectors_per_cluster = 1
+    while True:
+        cluster_size = sectors_per_cluster * sector_size
+        clusters = payload_clusters(payload, cluster_size) + -(-headroom // cluster_size)
+        sectors = esp_sectors(clusters, sectors_per_cluster)
+        recommended = Fat32.default_sectors_per_cluster(sectors, sector_size)
+        if recommended <= sectors_per_cluster:
+            break
+        sectors_per_cluster = recommended
+    # the partition is formatted with the cluster size recommended for its size,
+    # which may be smaller than the one it was planned with
+    while True:
+        last_lba = first_lba + sectors - 1
+        disk_sectors = -(-(last_lba + 1 + GPT_BACKUP_SECTORS) // ALIGNMENT) * ALIGNMENT
+        planned = layout(disk_sectors, last_lba)
+        if holds_payload(planned, payload, sector_size):
+            return planned
+        sectors += ALIGNMENT
+
+def current_layout(disk, sector_size=512):
     """
-        Parse the script arguments
+        Read the layout of an existing disk image, None if it has none
+    """
+    try:
+        partition = efi_partition(disk)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    sectors = partition.last_lba - partition.first_lba + 1
+    return Layout(os.path.getsize(disk) // sector_size, partition.first_lba, partition.last_lba,
+                  Fat32.default_sectors_per_cluster(sectors, sector_size))
+
+def holds_payload(layout, payload, sector_size=512):
+    """
+        Check if the partition of a layout is large enough for the payload
+    """
+    cluster_size = layout.sectors_per_cluster * sector_size
+    _, available = Fat32.geometry(layout.last_lba - layout.first_lba + 1,
+                                  layout.sectors_per_cluster)
+    return available >= payload_clusters(payload, cluster_size)
+
+class Manifest(object):
+    """
+        Cache describing the content of a disk image: its layout, the size,
+        modification time and hash of every payload file copied onto it, and
+        the container it was last converted to (qcow2 options).
+        It is stored next to the image, in the .cache directory.
+    """
+
+    # digests already computed in this process, by (path, size, mtime)
+    digests = dict()
+
+    def __init__(self, disk):
+        self._path = os.path.join(os.path.dirname(os.path.abspath(disk)), '.cache',
+                                  os.path.basename(disk) + '.json')
+        self.layout = None
+        self.files = dict()
+        self.container = None
+
+    def load(self):
+        """
+            Load the cache, an absent or unreadable cache is an empty one
+        """
+        try:
+            with open(self._path) as manifestf:
+                content = json.load(manifestf)
+            self.layout = content['layout']
+            self.files = content['files']
+            self.container = content.get('container')
+        except (IOError, OSError, ValueError, KeyError):
+            self.layout = None
+            self.files = dict()
+            self.container = None
+
+    def save(self):
+        """
+            Write the cache to disk
+        """
+        directory = os.path.dirname(self._path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = self._path + '.tmp'
+        with open(temporary, 'w') as manifestf:
+            json.dump({'layout': self.layout, 'files': self.files,
+                       'container': self.container},
+                      manifestf, indent=2, sort_keys=True)
+        os.rename(temporary, self._path)
+
+    def invalidate(self):
+        """
+            Remove the cache from disk, while the image is being modified
+        """
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def clean(self):
+        """
+            Forget everything about the image
+        """
+        logging.info("clean cache %s", self._path)
+        self.invalidate()
+        self.layout = None
+        self.files = dict()
+        self.container = None
+
+    @classmethod
+    def hash(cls, path):
+        """
+            Return the sha256 of a file, computed once per file version
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in cls.digests:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as filef:
+                for chunk in iter(lambda: filef.read(1 << 20), b''):
+                    digest.update(chunk)
+            cls.digests[key] = digest.hexdigest()
+        return cls.digests[key]
+
+    def changes(self, payload, force=False):
+        """
+            Compare the payload to the cache and update it.
+            Return the (system path, FAT path) pairs to copy and the FAT paths to remove.
+            Files whose size and modification time did not change are not hashed.
+        """
+        to_copy = list()
+        expected = set()
+        for syspath, fatpath in payload:
+            if os.path.isdir(syspath):
+                continue
+            expected.add(fatpath)
+            stat = os.stat(syspath)
+            cached = self.files.get(fatpath)
+            if not force and cached is not None and cached['size'] == stat.st_size \
+                    and cached['mtime'] == stat.st_mtime_ns:
+                continue
+            digest = self.hash(syspath)
+            if not force and cached is not None and cached['sha256'] == digest:
+                cached['mtime'] = stat.st_mtime_ns
+                continue
+            self.files[fatpath] = {'size': stat.st_size,
+                                   'mtime': stat.st_mtime_ns,
+                                   'sha256': digest}
+            to_copy.append((syspath, fatpath))
+        to_remove = sorted(fatpath for fatpath in self.files if fatpath not in expected)
+        for fatpath in to_remove:
+            del self.files[fatpath]
+        return to_copy, to_remove
+
+class GoldenCache(object):
+    """
+        Cache of blank, partitioned and formatted disk images (golden images)
+        keyed by their layout. New images are cloned from them.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def path(self, layout):
+        """
+            Path of the golden image of a layout
+        """
+        key = hashlib.sha256(json.dumps(layout, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, key[:16] + '.img')
+
+    def get(self, layout, create):
+        """
+            Return the golden image of a layout, built with create(path) if absent
+        """
+        path = self.path(layout)
+        if os.path.exists(path):
+            return path
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory, exist_ok=True)
+        # one build creates the image, the others (processes or threads) wait for it
+        with open(os.path.splitext(path)[0] + '.lock', 'a') as lockf:
+            fcntl.flock(lockf.fileno(), fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(path):
+                    logging.info("golden image: create %s", path)
+                    # built aside then renamed, no build ever sees a partial image
+                    fd, temporary = tempfile.mkstemp(suffix='.tmp', dir=self._directory)
+                    os.close(fd)
+                    try:
+                        create(temporary)
+                        os.rename(temporary, path)
+                    finally:
+                        if os.path.exists(temporary):
+                            os.remove(temporary)
+            finally:
+                fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+        return path
+
+@contextlib.contextmanager
+def image_lock(image, shared=False):
+    """
+        Lock a disk image through the <image>.lock file: builds take it exclusively,
+        readers (e.g. `flock -s uefi.img.lock qemu-system-x86_64 ...`) shared
+    """
+    with open(image + '.lock', 'a') as lockf:
+        with metrics.stage('lock', shared=shared):
+            fcntl.flock(lockf.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+
+class Inotify(object):
+    """
+        Minimal inotify binding (ctypes), raise EnvironmentError where unavailable
+    """
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        library = ctypes.util.find_library('c')
+        try:
+            self._libc = ctypes.CDLL(library, use_errno=True)
+            self._libc.inotify_init1
+        except (OSError, AttributeError):
+            raise EnvironmentError("inotify is not available")
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise EnvironmentError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        """
+            Watch a path, return the watch descriptor
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise EnvironmentError(ctypes.get_errno(), "inotify_add_watch failed", path)
+        return wd
+
+    def read(self, timeout=None):
+        """
+            Wait for events, return a list of (wd, mask, name)
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return list()
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return list()
+        events = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class PayloadWatcher(object):
+    """
+        Wait for the payload of an image to change: inotify watches the directories
+        of the payload, stat polling is used where inotify is not available
+    """
+    _MASK = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_MOVED_FROM \
+        | Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_DELETE_SELF \
+        | Inotify.IN_MOVE_SELF
+
+    def __init__(self, files, poll_interval=0.5):
+        self._files = [os.path.abspath(path) for path in files]
+        self._poll_interval = poll_interval
+        try:
+            self._inotify = Inotify()
+        except EnvironmentError as error:
+            logging.warning("%s, fall back to polling every %ss", error, poll_interval)
+            self._inotify = None
+        # watch descriptor -> basenames to watch (None: everything, recursively)
+        self._watches = dict()
+        if self._inotify is not None:
+            self._add_watches()
+        self._snapshot = self._stat()
+
+    def _directories(self):
+        directories = dict()
+        for path in self._files:
+            if os.path.isdir(path):
+                for dirpath, _, _ in os.walk(path):
+                    directories[dirpath] = None
+            else:
+                names = directories.setdefault(os.path.dirname(path), set())
+                if names is not None:
+                    names.add(os.path.basename(path))
+        return directories
+
+    def _add_watches(self):
+        # directories created since the last change are watched as well
+        self._watches = dict()
+        for directory, names in self._directories().items():
+            try:
+                wd = self._inotify.add_watch(directory, self._MASK)
+            except EnvironmentError as error:
+                logging.warning("cannot watch %s: %s", directory, error)
+                continue
+            self._watches[wd] = names
+
+    def _relevant(self, events):
+        relevant = False
+        for wd, mask, name in events:
+            # events of removed watches (IN_IGNORED ends them) are not changes
+            if wd not in self._watches:
+                continue
+            names = self._watches[wd]
+            if mask & Inotify.IN_IGNORED:
+                del self._watches[wd]
+            elif names is None or name in names \
+                    or mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+                relevant = True
+        return relevant
+
+    def _stat(self):
+        snapshot = dict()
+        for path in self._files:
+            paths = [path]
+            if os.path.isdir(path):
+                paths = [os.path.join(dirpath, name)
+                         for dirpath, dirnames, filenames in os.walk(path)
+                         for name in dirnames + filenames]
+            for item in paths:
+                try:
+                    stat = os.stat(item)
+                    snapshot[item] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    snapshot[item] = None
+        return snapshot
+
+    def wait(self, debounce=0.1):
+        """
+            Block until the payload changes and stays unchanged for debounce seconds
+        """
+        if self._inotify is not None:
+            while not self._relevant(self._inotify.read()):
+                pass
+            # partial writes: wait for the writers to be done
+            while self._inotify.read(debounce):
+                pass
+            self._add_watches()
+            return
+        while True:
+            time.sleep(self._poll_interval)
+            snapshot = self._stat()
+            if snapshot != self._snapshot:
+                break
+        while True:
+            time.sleep(debounce)
+            settled = self._stat()
+            if settled == snapshot:
+                break
+            snapshot = settled
+        self._snapshot = snapshot
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+def parse_args(arguments=None):
+    """
+        Parse the script arguments (sys.argv by default)
     """
     def check_path(path):
         """
@@ -338,76 +2249,410 @@ def parse_args():
     parser.add_argument('--force-copy',
                         action='store_true',
                         help='force replacing all files and updating cache')
-    parser.add_argument('--tool', nargs=1, metavar='[loopback-device | mtools]',
-                        default='loopback-device',
+    parser.add_argument('--alloc', choices=['sparse', 'preallocate', 'dd'],
+                        default='sparse',
+                        help='how the empty (zeroed) disk is allocated')
+    parser.add_argument('--golden-cache', metavar='DIRECTORY',
+                        help='directory of the golden images new disks are cloned from '\
+                        '(.cache/golden next to OUTFILE by default)')
+    parser.add_argument('--no-golden', dest='golden_cache',
+                        action='store_const', const='',
+                        help='always create new disks from scratch')
+    parser.add_argument('--partitioner', choices=['native', 'gdisk'],
+                        default='native',
+                        help='write the partition table in-process or through gdisk')
+    parser.add_argument('--tool', choices=['native', 'mtools', 'loopback-device'],
+                        default='native',
                         help="need root's rights to use loopback-device")
-    parser.add_argument('files', nargs='+',
+    parser.add_argument('--disk-size', type=int, metavar='MB',
+                        help='size of the disk (by default, the smallest one holding the files)')
+    parser.add_argument('--headroom', type=int, default=1, metavar='MB',
+                        help='free space left in the partition of an automatically sized disk')
+    parser.add_argument('--format', choices=['raw', 'qcow2'],
+                        default='raw',
+                        help='format of OUTFILE, a qcow2 image only stores the used clusters')
+    parser.add_argument('--compress',
+                        action='store_true',
+                        help='compress the clusters of a qcow2 image')
+    parser.add_argument('--session',
+                        action='store_true',
+                        help='keep the loopback device attached and the partition mounted '\
+                        'across builds (loopback-device only)')
+    parser.add_argument('--end-session',
+                        action='store_true',
+                        help='unmount and detach the session of OUTFILE, then exit')
+    parser.add_argument('--pack',
+                        action='store_true',
+                        help='the files are EFI tests, laid out as tests/<name>/<name>.efi '\
+                        'and run one after the other by a generated startup.nsh')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='keep running, update the image every time the files change')
+    parser.add_argument('--debounce', type=int, default=100, metavar='MS',
+                        help='in watch mode, time the files must stay unchanged '\
+                        'before the image is updated')
+    parser.add_argument('--seed', metavar='SEED',
+                        help='derive the GUIDs and the volume ID from SEED and date the FAT '\
+                        'entries with SOURCE_DATE_EPOCH (1980-01-01 by default), so that '\
+                        'the same files give the same image (SOURCE_DATE_EPOCH is the '\
+                        'default seed)')
+    parser.add_argument('--metrics-json', metavar='METRICS',
+                        help='write the per stage timing and I/O events to this JSON file')
+    parser.add_argument('files', nargs='*',
                         type=check_path,
                         metavar='FILE')
-    args = parser.parse_args()
+    args = parser.parse_args(arguments)
+    if args.compress and args.format != 'qcow2':
+        parser.error("--compress requires --format=qcow2")
+    if args.session and args.tool != 'loopback-device':
+        parser.error("--session requires --tool=loopback-device")
+    if not args.files and not args.end_session:
+        parser.error("the following arguments are required: FILE")
 
-    if not os.path.exists(args.output):
+    # deterministic mode
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch is not None and not epoch.isdigit():
+        parser.error("SOURCE_DATE_EPOCH must be a number of seconds, not {}".format(epoch))
+    if args.seed is None:
+        args.seed = epoch
+    args.timestamp = None
+    if args.seed is not None:
+        args.timestamp = max(int(epoch), FAT_EPOCH) if epoch is not None else FAT_EPOCH
+
+    # the raw image is updated in place, then converted to the output format
+    args.image = args.output
+    if args.format != 'raw':
+        args.image = os.path.join(os.path.dirname(os.path.abspath(args.output)), '.cache',
+                                  os.path.basename(args.output) + '.raw')
+        if not os.path.isdir(os.path.dirname(args.image)):
+            os.makedirs(os.path.dirname(args.image))
+    if not os.path.exists(args.image):
         args.clean_cache = True
         args.force_dd = True
+    if args.golden_cache is None:
+        args.golden_cache = os.path.join(os.path.dirname(os.path.abspath(args.output)),
+                                         '.cache', 'golden')
 
     return args
 
-def proceed_as_root(args):
+def proceed_as_root(args, format_partition, to_copy, to_remove):
     """
-        Create a disk image with root's capabilities using losetup and mount
+        Create a disk image with root's capabilities using losetup and mount.
+        In session mode, the device stays attached and the partition mounted
+        after the build.
     """
-    diskname = args.output
-    with Losetup(diskname) as (device, partitions):
-        partition = partitions[0]
-        mkfsFAT32(partition)
+    diskname = args.image
+    esp = efi_partition(diskname)
+    sectors_per_cluster = Fat32.default_sectors_per_cluster(esp.last_lba - esp.first_lba + 1)
+    volume_id = None if args.seed is None else seeded_volume_id(args.seed)
+    if args.seed is not None:
+        logging.warning("the kernel dates the FAT entries it creates with the current "\
+                        "time: loopback-device images are not byte-reproducible")
+    with contextlib.ExitStack() as stack:
+        if args.session:
+            session = LoopSession(diskname)
+            if not session.load():
+                session.start()
+            partition = session.partition
+            if format_partition:
+                if session.mounted:
+                    session.unmount()
+                with metrics.stage('format', tool=args.tool):
+                    mkfsFAT32(partition, sectors_per_cluster, volume_id)
+            if not session.mounted:
+                session.mount()
+            mount_point = session.mount_point
+        else:
+            device, partitions = stack.enter_context(Losetup(diskname))
+            partition = partitions[0]
+            if format_partition:
+                with metrics.stage('format', tool=args.tool):
+                    mkfsFAT32(partition, sectors_per_cluster, volume_id)
+            mount_point = stack.enter_context(Mount(partition))
 
-        with Mount(partition) as mount_point:
-            for name in args.files:
-                logging.info("copy %s to %s", name, partition)
-                if os.path.isdir(name):
-                    shutil.copytree(name, mount_point)
+        with metrics.stage('remove', files=len(to_remove)):
+            for fatpath in to_remove:
+                logging.info("remove %s from %s", fatpath, partition)
+                path = os.path.join(mount_point, fatpath)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+        with metrics.stage('copy', files=len(to_copy)):
+            for syspath, fatpath in to_copy:
+                logging.info("copy %s to %s", syspath, partition)
+                path = os.path.join(mount_point, fatpath)
+                if os.path.isdir(syspath):
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
                 else:
-                    shutil.copy(name, mount_point)
+                    shutil.copy(syspath, path)
+                    metrics.add_bytes(os.path.getsize(syspath))
+                if args.timestamp is not None:
+                    os.utime(path, (args.timestamp, args.timestamp))
+        if args.session:
+            # the image file is up to date once the mounted partition is flushed
+            with metrics.stage('sync'):
+                os.sync()
 
-def proceed_as_standard_user(args):
+def proceed_as_standard_user(args, format_partition, to_copy, to_remove):
     """
-        Create a disk image with a standard user's capabilities
+        Create a disk image with a standard user's capabilities using mtools
     """
-    diskname = args.output
-    disksize = os.path.getsize(diskname)
-    tmp_partition = tempfile.mktemp(dir='/tmp', prefix='partfat32-')
-    dd(tmp_partition, disksize - 2048)
-    with Mtools(tmp_partition) as mtools:
-        mtools.format()
-        for name in args.files:
-            mtools.copy(name)
-    dd(outputf=diskname, size=disksize - 2048, inputf=tmp_partition, seek=2048)
-    os.remove(tmp_partition)
+    partition = efi_partition(args.image)
+    sectors = partition.last_lba - partition.first_lba + 1
+    with Mtools(args.image, partition.first_lba * 512, sectors, args.timestamp) as mtools:
+        if format_partition:
+            with metrics.stage('format', tool=args.tool):
+                mtools.format(seeded_volume_id(args.seed))
+            with metrics.stage('copy', files=len(to_copy)):
+                # everything is copied: let mcopy walk the directories itself
+                mtools.copy(payload_files(args))
+                metrics.add_bytes(sum(os.path.getsize(syspath) for syspath, _ in to_copy
+                                      if not os.path.isdir(syspath)))
+            return
+        with metrics.stage('remove', files=len(to_remove)):
+            mtools.remove(to_remove)
+        with metrics.stage('copy', files=len(to_copy)):
+            mtools.mkdirs([fatpath for syspath, fatpath in to_copy if os.path.isdir(syspath)])
+            # the changed files are linked at their FAT path in a staging tree,
+            # pushed by a single mcopy whatever the number of directories
+            staging = tempfile.mkdtemp(prefix='mcopy-')
+            try:
+                for syspath, fatpath in to_copy:
+                    if os.path.isdir(syspath):
+                        continue
+                    metrics.add_bytes(os.path.getsize(syspath))
+                    target = os.path.join(staging, *fatpath.split('/'))
+                    if not os.path.isdir(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+                    os.symlink(os.path.abspath(syspath), target)
+                mtools.copy([os.path.join(staging, name) for name in sorted(os.listdir(staging))])
+            finally:
+                shutil.rmtree(staging)
 
-def run(args):
+def efi_partition(disk):
     """
-        main function
+        Return the first EFI system partition of a disk image
     """
-    disk_size = 46 * 1024 * 1024 # MB
+    for partition in read_gpt(disk):
+        if partition.type_guid == EFI_SYSTEM_PARTITION:
+            return partition
+    raise ValueError("{disk} has no EFI system partition".format(disk=disk))
 
-    print(args)
-    if args.force_dd:
-        dd(args.output, disk_size)
+def proceed_natively(args, format_partition, to_copy, to_remove):
+    """
+        Create a disk image in-process, writing the FAT32 partition in place
+    """
+    partition = efi_partition(args.image)
+    sectors = partition.last_lba - partition.first_lba + 1
+    with Fat32(args.image, partition.first_lba, sectors, timestamp=args.timestamp) as fat:
+        if format_partition:
+            with metrics.stage('format', tool=args.tool):
+                fat.format(volume_id=seeded_volume_id(args.seed))
+        with metrics.stage('remove', files=len(to_remove)):
+            for fatpath in to_remove:
+                fat.remove(fatpath)
+        with metrics.stage('copy', files=len(to_copy)):
+            for syspath, fatpath in to_copy:
+                if os.path.isdir(syspath):
+                    fat.mkdir(fatpath)
+                else:
+                    fat.write_file(syspath, fatpath)
 
-        with Gdisk(args.output) as partitioner:
-            partitioner.cmd_newtable()
-            partitioner.cmd_newpartition('EFI')
-            partitioner.cmd_printtable()
-            partitioner.cmd_writetable()
+def partition_disk(disk, layout, partitioner='native', seed=None):
+    """
+        Write a new GPT holding a single EFI system partition,
+        its GUIDs are derived from seed when it is given
+    """
+    partitioner_class = Gdisk if partitioner == 'gdisk' else GptWriter
+    with metrics.stage('partition', partitioner=partitioner), \
+            partitioner_class(disk, seed=seed) as partitioner:
+        partitioner.cmd_newtable()
+        partitioner.cmd_newpartition('EFI', layout.first_lba, layout.last_lba)
+        partitioner.cmd_printtable()
+        partitioner.cmd_writetable()
 
+def format_disk(disk, tool, seed=None, timestamp=None):
+    """
+        Format the EFI system partition of a disk without root's rights
+    """
+    partition = efi_partition(disk)
+    sectors = partition.last_lba - partition.first_lba + 1
+    with metrics.stage('format', tool=tool):
+        if tool == 'mtools':
+            with Mtools(disk, partition.first_lba * 512, sectors, timestamp) as mtools:
+                mtools.format(seeded_volume_id(seed))
+        else:
+            with Fat32(disk, partition.first_lba, sectors, timestamp=timestamp) as fat:
+                fat.format(volume_id=seeded_volume_id(seed))
+
+def create_from_golden(args, layout):
+    """
+        Create the disk by cloning the golden image of its layout, then give it
+        its own identifiers (disk and partition GUIDs, volume ID).
+    """
+    def create(path):
+        allocate(path, layout.disk_sectors * 512)
+        partition_disk(path, layout, seed=args.seed)
+        format_disk(path, args.tool, args.seed, args.timestamp)
+
+    with metrics.stage('golden'):
+        golden = GoldenCache(args.golden_cache).get({'layout': layout._asdict(),
+                                                      'partitions': ['EFI'],
+                                                      'tool': args.tool,
+                                                      'seed': args.seed,
+                                                      'timestamp': args.timestamp},
+                                                     create)
+    with metrics.stage('clone', golden=golden):
+        method = clone_file(golden, args.image)
+        logging.info("clone %s from golden image %s: %s", args.image, golden, method)
+    partition_disk(args.image, layout, seed=args.seed)
+    partition = efi_partition(args.image)
+    with Fat32(args.image, partition.first_lba,
+               partition.last_lba - partition.first_lba + 1) as fat:
+        fat.set_volume_id(seeded_volume_id(args.seed))
+
+def run(args, hook=None):
+    """
+        main function, hook(event) is called at the end of every stage
+    """
+    metrics.reset()
+    if hook is not None:
+        metrics.hooks.append(hook)
+    try:
+        with metrics.stage('run', output=args.output, tool=args.tool), \
+                image_lock(args.output):
+            if args.end_session:
+                LoopSession(args.image).stop()
+                return
+            modified = build(args)
+            if args.format == 'qcow2':
+                # converted again when the image or the qcow2 options changed
+                manifest = Manifest(args.output)
+                manifest.load()
+                container = {'format': args.format, 'compress': args.compress}
+                if modified or manifest.container != container \
+                        or not os.path.exists(args.output):
+                    convert_qcow2(args.image, args.output, args.compress)
+                    manifest.container = container
+                    manifest.save()
+    finally:
+        if hook is not None:
+            metrics.hooks.remove(hook)
+        if getattr(args, 'metrics_json', None):
+            metrics.report(args.metrics_json)
+
+def build(args):
+    """
+        Create or update the raw disk image, return True if it was modified
+    """
+    logging.debug("%s", args)
+    if args.pack:
+        pack_tests(args.output, args.files)
+    payload = list_payload(payload_files(args))
+    disk_size = None if args.disk_size is None else args.disk_size * 1024 * 1024 # MB
+    # the caller's args are left untouched: a layout change only forces this build
+    force_dd = args.force_dd
+    with metrics.stage('layout'):
+        layout = plan_layout(payload, disk_size, args.headroom * 1024 * 1024)
+        if not force_dd:
+            existing = current_layout(args.image)
+            # without explicit size, the disk only grows when the payload outgrows it
+            if existing is None or (existing != layout if disk_size is not None
+                                    else not holds_payload(existing, payload)):
+                logging.info("layout changed: %s", layout)
+                force_dd = True
+            else:
+                layout = existing
+
+    # a live session must not see its image rewritten behind its back
+    session = LoopSession(args.image)
+    if session.load() and (force_dd or not args.session):
+        session.stop()
+
+    formatted = False
+    if force_dd:
+        # golden images are sparse, built without root's rights, with the native partitioner
+        if args.golden_cache and args.alloc == 'sparse' and args.partitioner == 'native' \
+                and args.tool in ('native', 'mtools'):
+            create_from_golden(args, layout)
+            formatted = True
+        else:
+            allocate(args.image, layout.disk_sectors * 512, args.alloc)
+            partition_disk(args.image, layout, args.partitioner, args.seed)
+
+    with metrics.stage('manifest'):
+        manifest = Manifest(args.output)
+        if args.clean_cache:
+            manifest.clean()
+        else:
+            manifest.load()
+
+        partition = efi_partition(args.image)
+        layout = {'disk_size': os.path.getsize(args.image),
+                  'first_lba': partition.first_lba,
+                  'last_lba': partition.last_lba,
+                  'tool': args.tool,
+                  'seed': args.seed,
+                  'timestamp': args.timestamp}
+        format_partition = not formatted and (force_dd or args.force_format
+                                              or manifest.layout != layout)
+        if formatted or format_partition:
+            manifest.files = dict()
+        to_copy, to_remove = manifest.changes(payload, force=args.force_copy)
+    if not (format_partition or to_copy or to_remove):
+        logging.info("cache up to date, nothing to do")
+        return False
+    if args.seed is not None and not force_dd:
+        # an update in place depends on the history of the image (allocation
+        # order, stale data in freed clusters): start again from an empty disk
+        logging.info("deterministic image changed, create it again")
+        return build(argparse.Namespace(**dict(vars(args), force_dd=True, clean_cache=True)))
+    # directories are (re)created when anything is copied, in case they are empty
+    to_copy = [(syspath, fatpath) for syspath, fatpath in payload
+               if os.path.isdir(syspath)] + to_copy
+
+    manifest.invalidate()
     if args.tool == 'loopback-device':
         if is_user_root():
-            proceed_as_root(args)
+            proceed_as_root(args, format_partition, to_copy, to_remove)
         else:
             raise EnvironmentError("need to be root to use loopback devices")
+    elif args.tool == 'mtools':
+        proceed_as_standard_user(args, format_partition, to_copy, to_remove)
     else:
-        proceed_as_standard_user(args)
+        proceed_natively(args, format_partition, to_copy, to_remove)
+    manifest.layout = layout
+    manifest.save()
+    return True
+
+def watch(args):
+    """
+        Update the image every time its payload changes, until interrupted
+    """
+    # watch before the first build so that no change is missed
+    watcher = PayloadWatcher(args.files)
+    try:
+        run(args)
+        # only the first build honours the --force-* options
+        args.clean_cache = args.force_dd = args.force_format = args.force_copy = False
+        logging.info("watching %s", ", ".join(args.files))
+        while True:
+            watcher.wait(args.debounce / 1000.0)
+            try:
+                run(args)
+            except Exception:
+                logging.exception("%s: update failed", args.output)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.DEBUG)
-    run(parse_args())
+    arguments = parse_args()
+    if arguments.watch:
+        watch(arguments)
+    else:
+        run(arguments)
@@ -3,22 +3,111 @@
 
 import os
 import re
-import io
-from collections import namedtuple
+import mmap
+import struct
+from collections import namedtuple, OrderedDict
 import argparse
+import sys
+import threading
 import gdb
 
+# the serial bridge lives next to this script
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass
+
 class EFISections(object):
+    """
+        Section table of a PE/COFF image, addresses are relative to its image base
+    """
 
-    Section = namedtuple('Section', ['begin', 'end'])
-    _sections = dict()
+    Section = namedtuple('Section', ['begin', 'end', 'characteristics'])
 
-    def add(self, name, begin, end):
-        self._sections[name] = self.Section(begin, end)
+    IMAGE_SCN_CNT_UNINITIALIZED_DATA = 0x00000080
+    IMAGE_SCN_MEM_DISCARDABLE = 0x02000000
+
+    def __init__(self):
+        self._sections = OrderedDict()
+
+    def add(self, name, begin, end, characteristics=0):
+        self._sections[name] = self.Section(begin, end, characteristics)
 
     def __getitem__(self, key):
         return self._sections[key]
 
+    def __contains__(self, key):
+        return key in self._sections
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    def loaded(self):
+        """
+            Names of the sections loaded in memory (neither discardable nor empty)
+        """
+        return [name for name, section in self._sections.items()
+                if section.end > section.begin
+                and not section.characteristics & self.IMAGE_SCN_MEM_DISCARDABLE]
+
+class PEReader(object):
+    """
+        Read the section table of a PE/COFF image straight from its headers
+    """
+
+    _DOS_SIGNATURE = b'MZ'
+    _PE_SIGNATURE = b'PE\0\0'
+    _PE_OFFSET = struct.Struct('<I')  # e_lfanew, at 0x3c
+    _COFF_HEADER = struct.Struct('<HHIIIHH')
+    _SECTION_HEADER = struct.Struct('<8sIIIIIIHHI')
+    _SYMBOL_SIZE = 18
+
+    # sections of the images already read, by (path, mtime)
+    _cache = dict()
+
+    @classmethod
+    def sections(cls, path):
+        """
+            Return the EFISections of an image, read once per version of the file
+        """
+        key = (os.path.abspath(path), os.stat(path).st_mtime)
+        if key not in cls._cache:
+            with open(path, 'rb') as imagef:
+                image = mmap.mmap(imagef.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    cls._cache[key] = cls._read(image, path)
+                finally:
+                    image.close()
+        return cls._cache[key]
+
+    @classmethod
+    def _read(cls, image, path):
+        if image[0:2] != cls._DOS_SIGNATURE:
+            raise ValueError("{path} is not a PE image (no MZ signature)".format(path=path))
+        pe_offset, = cls._PE_OFFSET.unpack_from(image, 0x3c)
+        if image[pe_offset:pe_offset + 4] != cls._PE_SIGNATURE:
+            raise ValueError("{path} is not a PE image (no PE signature)".format(path=path))
+        coff_offset = pe_offset + 4
+        (_, number_of_sections, _, symbol_table, number_of_symbols,
+         optional_header_size, _) = cls._COFF_HEADER.unpack_from(image, coff_offset)
+        # the long section names are in the string table, after the symbols
+        string_table = symbol_table + number_of_symbols * cls._SYMBOL_SIZE
+
+        sections = EFISections()
+        offset = coff_offset + cls._COFF_HEADER.size + optional_header_size
+        for _ in range(number_of_sections):
+            (name, virtual_size, virtual_address, raw_size, _, _, _, _, _,
+             characteristics) = cls._SECTION_HEADER.unpack_from(image, offset)
+            offset += cls._SECTION_HEADER.size
+            name = name.rstrip(b'\0')
+            if name.startswith(b'/') and symbol_table:
+                start = string_table + int(name[1:])
+                name = image[start:image.find(b'\0', start)]
+            size = virtual_size or raw_size
+            sections.add(name.decode('ascii'), virtual_address, virtual_address + size,
+                         characteristics)
+        return sections
+
 def unload_executable():
     gdb.execute('file')
 
@@ -26,27 +115,75 @@ def set_architecture():
     gdb.execute('set architecture i386:x86-64:intel')
 
 def load_debugsymbols(libname, image_base, sections):
-    text_section = int(image_base, 16) + int(sections['.text'].begin, 16)
-    data_section = int(image_base, 16) + int(sections['.data'].begin, 16)
-    gdb.execute('add-symbol-file {} {:#x} -s .data {:#x}'.format(libname,
-                                                                 text_section,
-                                                                 data_section))
-
-def getSections():
-    import sys
-    info_sections = gdb.execute('info files', to_string=True)
-    #print(type(info_sections))
-    if sys.version_info.major == 2 and sys.version_info.minor <= 7:
-        #print(type(info_sections.decode('utf-8')))
-        info_sections = info_sections.decode('utf-8')
-    buf = io.StringIO(info_sections)
-    compiled_pattern = re.compile(r'^\s+(0x[0-9A-Fa-f]+)[\s\-]+(0x[0-9A-Fa-f]+)\sis\s(\.[a-z_]+)$')
-    efi_sections = EFISections()
-    for line in buf.readlines():
-        result = compiled_pattern.match(line)
-        if result is not None:
-            efi_sections.add(result.group(3), result.group(1), result.group(2))
-    return efi_sections
+    """
+        Load the symbols of the image with every loaded section at its address
+    """
+    base = int(image_base, 16)
+    if '.text' not in sections:
+        raise gdb.GdbError("{} has no .text section".format(libname))
+    command = ['add-symbol-file', libname, '{:#x}'.format(base + sections['.text'].begin)]
+    for name in sections.loaded():
+        if name != '.text':
+            command.append('-s {} {:#x}'.format(name, base + sections[name].begin))
+    gdb.execute(' '.join(command))
+
+def getSections(libname):
+    return PEReader.sections(libname)
+
+def find_symbol_file(name, symbol_dirs):
+    """
+        Find the file with debug symbols of a module (Foo or Foo.efi) in the
+        symbol directories, return None if there is none
+    """
+    stem = os.path.splitext(os.path.basename(name))[0]
+    candidates = [stem + '.debug', stem + '-debug.efi', stem + '.efi', stem + '.dll']
+    for directory in symbol_dirs:
+        for candidate in candidates:
+            path = os.path.join(directory, candidate)
+            if os.path.isfile(path):
+                return path
+    return None
+
+def parse_load_log(logname, symbol_dirs):
+    """
+        Return the (symbol file, image base) pairs listed in a log file, either
+        as "FILE IMAGE_BASE" lines or as OVMF debug output:
+            Loading driver at 0x0007F9E8000 EntryPoint=0x0007F9EC2C8 DevicePathDxe.efi
+        Modules of OVMF logs are looked up in the symbol directories.
+    """
+    ovmf_pattern = re.compile(r'Loading (?:driver|PEIM) at (0x[0-9A-Fa-f]+) '
+                              r'EntryPoint=0x[0-9A-Fa-f]+ (\S+)')
+    pair_pattern = re.compile(r'^\s*(\S+)\s+(0x[0-9A-Fa-f]+)\s*$')
+    modules = list()
+    with open(logname) as logf:
+        for line in logf:
+            result = ovmf_pattern.search(line)
+            if result is not None:
+                path = find_symbol_file(result.group(2), symbol_dirs)
+                if path is None:
+                    gdb.write("no symbols for {}\n".format(result.group(2)), gdb.STDERR)
+                    continue
+                modules.append((path, result.group(1)))
+                continue
+            result = pair_pattern.match(line)
+            if result is not None and not line.lstrip().startswith('#'):
+                modules.append((result.group(1), result.group(2)))
+    return modules
+
+def load_modules(modules):
+    """
+        Load the symbols of many modules in one batch: the executable is unloaded
+        and the architecture set only once, confirmations are disabled meanwhile
+    """
+    confirm = gdb.parameter('confirm')
+    gdb.execute('set confirm off')
+    try:
+        unload_executable()
+        for libname, image_base in modules:
+            load_debugsymbols(libname, image_base, getSections(libname))
+        set_architecture()
+    finally:
+        gdb.execute('set confirm {}'.format('on' if confirm else 'off'))
 
 def parse_args(arguments):
     """
@@ -63,14 +200,33 @@ def parse_args(arguments):
     parser = argparse.ArgumentParser(description='Set up GDB for EFI debugging.')
     parser.add_argument('-f', '--file-with-symbols',
                         metavar='FILE_WITH_SYMBOLS',
-                        required=True,
                         type=check_path,
                         help='PE executable with debug symbols')
     parser.add_argument('-b', '--image-base',
                         metavar='IMAGE_BASE',
-                        required=True,
                         help='Image base')
+    parser.add_argument('-m', '--module', nargs=2, action='append',
+                        default=list(),
+                        metavar=('FILE_WITH_SYMBOLS', 'IMAGE_BASE'),
+                        help='PE executable with debug symbols and its image base '\
+                        '(repeatable)')
+    parser.add_argument('-l', '--load-log',
+                        metavar='LOG',
+                        type=check_path,
+                        help='file listing "FILE_WITH_SYMBOLS IMAGE_BASE" lines, '\
+                        'or OVMF debug output')
+    parser.add_argument('-d', '--symbol-dir', action='append',
+                        default=list(),
+                        metavar='DIRECTORY',
+                        type=check_path,
+                        help='where the modules of an OVMF log are looked up (repeatable)')
     args = parser.parse_args(arguments)
+    if (args.file_with_symbols is None) != (args.image_base is None):
+        parser.error("-f and -b go together")
+    if args.file_with_symbols is None and not args.module and args.load_log is None:
+        parser.error("one of -f/-b, -m or -l is required")
+    for libname, _ in args.module:
+        check_path(libname)
     return args
 
 
@@ -85,13 +241,83 @@ class EFIDebugHelper(gdb.Command):
 
     def invoke(self, argument, from_tty):
         args = parse_args(argument.split())
-        efi_sections = getSections()
-        unload_executable()
-        load_debugsymbols(args.file_with_symbols, args.image_base, efi_sections)
-        set_architecture()
+        modules = list()
+        if args.file_with_symbols is not None:
+            modules.append((args.file_with_symbols, args.image_base))
+        for libname, image_base in args.module:
+            modules.append((libname, image_base))
+        if args.load_log is not None:
+            modules.extend(parse_load_log(args.load_log, args.symbol_dir or ['.']))
+        load_modules(modules)
+        gdb.write("symbols of {} modules loaded\n".format(len(modules)), gdb.STDOUT)
+
+class EFISerialBridge(gdb.Command):
+    """
+        Stream the serial console of QEMU in the background and load the
+        symbols of the EFI application as soon as it prints its image base
+    """
+
+    def __init__(self):
+        super(EFISerialBridge, self).__init__('efiserial', gdb.COMMAND_FILES)
+        self._thread = None
+
+    @staticmethod
+    def parse_args(arguments):
+        parser = argparse.ArgumentParser(prog='efiserial',
+                                         description='Serial console bridge.')
+        parser.add_argument('-f', '--file-with-symbols',
+                            metavar='FILE_WITH_SYMBOLS',
+                            required=True,
+                            help='PE executable with debug symbols')
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('-p', '--port', type=int, default=5555)
+        parser.add_argument('--log', metavar='LOG',
+                            help='also write the serial output to this file')
+        parser.add_argument('-q', '--quiet', action='store_true',
+                            help='do not echo the serial output in gdb')
+        return parser.parse_args(arguments)
+
+    def invoke(self, argument, from_tty):
+        import asyncio
+        import efiserialbridge
+
+        if self._thread is not None and self._thread.is_alive():
+            raise gdb.GdbError("the serial bridge is already running")
+        args = self.parse_args(argument.split())
+
+        # gdb is not thread safe: everything happens through its event loop
+        def on_image_base(image_base):
+            gdb.post_event(lambda: self.load(args.file_with_symbols, image_base))
+
+        def output(text):
+            gdb.post_event(lambda: gdb.write(text, gdb.STDOUT))
+
+        bridge = efiserialbridge.SerialBridge(args.host, args.port, on_image_base,
+                                              None if args.quiet else output, args.log)
+
+        def serve():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(bridge.run())
+            finally:
+                loop.close()
+
+        self._thread = threading.Thread(target=serve, name='efiserial')
+        self._thread.daemon = True
+        self._thread.start()
+        gdb.write("serial bridge to {}:{} started\n".format(args.host, args.port), gdb.STDOUT)
+
+    @staticmethod
+    def load(libname, image_base):
+        gdb.write("\nimage base {}: loading {}\n".format(image_base, libname), gdb.STDOUT)
+        load_modules([(libname, image_base)])
 
 
 gdb.write("EFI debug helper\n", gdb.STDOUT)
 gdb.write("----------------\n", gdb.STDOUT)
 gdb.write(" * efidebug -f <file with debug symbols> -b <image base>\n", gdb.STDOUT)
+gdb.write(" * efidebug -m <file> <image base> [-m <file> <image base> ...]\n", gdb.STDOUT)
+gdb.write(" * efidebug -l <load log> [-d <symbol directory> ...]\n", gdb.STDOUT)
+gdb.write(" * efiserial -f <file with debug symbols> [-p <port>]\n", gdb.STDOUT)
 EFIDebugHelper()
+EFISerialBridge()
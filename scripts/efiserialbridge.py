@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sys
+import termios
+import tty
+
+
+IMAGE_BASE_PATTERN = re.compile(r'Image base: (0x[0-9A-Fa-f]+)')
+# cursor moves and attributes of the UEFI console
+ESCAPE_PATTERN = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+# Ctrl-], like telnet: the terminal is raw, Ctrl-C goes to the firmware
+QUIT_KEY = b'\x1d'
+
+class SerialBridge(object):
+    """
+        Console bridge to the serial port QEMU serves on a TCP socket
+        (-serial tcp::5555,server). The output is streamed to output() and to
+        the log file, and on_image_base(image_base) is called for every
+        "Image base: 0x..." line printed by an EFI application.
+    """
+
+    def __init__(self, host='localhost', port=5555, on_image_base=None,
+                 output=None, logname=None, retry=0.5):
+        self._host = host
+        self._port = port
+        self._on_image_base = on_image_base
+        self._output = output
+        self._logname = logname
+        self._retry = retry
+        self._writer = None
+        self._line = ''
+
+    async def _connect(self):
+        # QEMU may not listen yet, wait for it
+        while True:
+            try:
+                return await asyncio.open_connection(self._host, self._port)
+            except OSError as error:
+                logging.debug("serial: %s:%d: %s, retrying", self._host, self._port, error)
+                await asyncio.sleep(self._retry)
+
+    def _scan(self, text):
+        lines = (self._line + text).split('\n')
+        self._line = lines.pop()
+        for line in lines:
+            result = IMAGE_BASE_PATTERN.search(ESCAPE_PATTERN.sub('', line))
+            if result is not None and self._on_image_base is not None:
+                self._on_image_base(result.group(1))
+
+    async def run(self):
+        """
+            Stream the serial output until QEMU closes the connection
+        """
+        reader, self._writer = await self._connect()
+        logging.info("serial: connected to %s:%d", self._host, self._port)
+        logf = open(self._logname, 'ab') if self._logname else None
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                if logf is not None:
+                    logf.write(data)
+                    logf.flush()
+                text = data.decode('utf-8', errors='replace')
+                if self._output is not None:
+                    self._output(text)
+                self._scan(text.replace('\r', ''))
+        finally:
+            if logf is not None:
+                logf.close()
+            self._writer.close()
+            self._writer = None
+        logging.info("serial: connection closed")
+
+    def send(self, data):
+        """
+            Write to the serial port (keyboard input of the UEFI console)
+        """
+        if self._writer is not None:
+            self._writer.write(data)
+
+def forward_stdin(loop, bridge, quit):
+    """
+        Send what is typed on the terminal to the serial port, key by key
+        (the terminal is in raw mode), call quit() on QUIT_KEY
+    """
+    def read():
+        data = os.read(sys.stdin.fileno(), 1024)
+        if QUIT_KEY in data:
+            data = data[:data.index(QUIT_KEY)]
+            loop.remove_reader(sys.stdin.fileno())
+            quit()
+        elif not data:
+            loop.remove_reader(sys.stdin.fileno())
+        if data:
+            bridge.send(data.replace(b'\n', b'\r'))
+    loop.add_reader(sys.stdin.fileno(), read)
+
+def parse_args(arguments=None):
+    """
+        Parse the script arguments
+    """
+    parser = argparse.ArgumentParser(description='Serial console of a QEMU virtual machine, '\
+                                     'reporting the image base of the EFI application.')
+    parser.add_argument('--host', default='localhost',
+                        help='host serving the serial port')
+    parser.add_argument('-p', '--port', type=int, default=5555,
+                        help='TCP port serving the serial port')
+    parser.add_argument('-f', '--file-with-symbols',
+                        metavar='FILE_WITH_SYMBOLS',
+                        help='PE executable with debug symbols, used in the printed '\
+                        'efidebug command')
+    parser.add_argument('--log', metavar='LOG',
+                        help='also write the serial output to this file')
+    return parser.parse_args(arguments)
+
+def run(args):
+    """
+        main function
+    """
+    def on_image_base(image_base):
+        sys.stderr.write("\r\n[efiserialbridge] efidebug -f {} -b {}\r\n"
+                         .format(args.file_with_symbols or '<file with debug symbols>',
+                                 image_base))
+
+    def output(text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    bridge = SerialBridge(args.host, args.port, on_image_base, output, args.log)
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(bridge.run())
+    settings = None
+    if sys.stdin.isatty():
+        # keys (Esc, arrows, ...) reach the firmware as they are typed, without local echo
+        settings = termios.tcgetattr(sys.stdin.fileno())
+        tty.setraw(sys.stdin.fileno())
+        sys.stderr.write("[efiserialbridge] Ctrl-] to quit\r\n")
+        forward_stdin(loop, bridge, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        if settings is not None:
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, settings)
+        loop.close()
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    run(parse_args())
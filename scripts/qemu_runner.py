@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+import argparse
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+import create_disk
+
+
+# cursor moves and attributes of the UEFI console
+ESCAPE_PATTERN = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+# prompt of the UEFI shell: "Shell> ", "FS0:\> ", "FS0:\EFI\> "
+PROMPT_PATTERN = re.compile(r'(?:Shell|[A-Za-z]+\d+:\\[^>\n]*)> ')
+# typed in the UEFI shell of a restored snapshot, once the payload is attached
+SNAPSHOT_COMMANDS = ['map -r', r'fs0:\startup.nsh']
+# lines printed by the startup.nsh of a pack of tests (create_disk.py --pack)
+PACK_RESULT_PATTERN = re.compile(r'^\s*{}\s+(\S+)\s+(0x[0-9A-Fa-f]+|\d+)\s*$'
+                                 .format(re.escape(create_disk.PACK_RESULT)))
+PACK_DONE_PATTERN = re.compile(r'^\s*{}\s+(\d+)\s*$'.format(re.escape(create_disk.PACK_DONE)))
+
+def accelerator(requested='auto'):
+    """
+        Return the accelerator to use: KVM when /dev/kvm is usable, TCG otherwise
+    """
+    if requested != 'auto':
+        return requested
+    if os.access('/dev/kvm', os.R_OK | os.W_OK):
+        return 'kvm'
+    return 'tcg'
+
+def qemu_command(args, overlay, accel, qmp=None, varstore=None):
+    """
+        Build the command line of a headless virtual machine booting an overlay,
+        its serial console on stdout. In snapshot mode, the virtual machine has
+        a USB controller instead of a disk (the payload is plugged in later)
+        and a QMP socket. With a variable store, --ovmf is the firmware code.
+    """
+    command = [args.qemu,
+               '-machine', 'accel={}'.format(accel),
+               '-cpu', 'kvm64' if accel == 'kvm' else 'qemu64',
+               '-m', str(args.memory),
+               '-display', 'none',
+               '-monitor', 'none',
+               '-serial', 'stdio',
+               '-no-reboot',
+               '-drive', 'if=pflash,format=raw,unit=0,file={},readonly=on'.format(args.ovmf)]
+    if varstore is not None:
+        command.extend(['-drive', 'if=pflash,format=raw,unit=1,file={}'.format(varstore)])
+    if args.snapshot_dir:
+        command.extend(['-device', 'qemu-xhci,id=xhci'])
+    else:
+        command.extend(['-drive', 'if=ide,format=qcow2,file={}'.format(overlay)])
+    if qmp is not None:
+        command.extend(['-qmp', 'unix:{},server,nowait'.format(qmp)])
+    return command + args.qemu_args
+
+def rewrite_changed_blocks(source, destination, block_size=1 << 16):
+    """
+        Make destination a copy of source (same size) by rewriting only the
+        blocks which differ
+    """
+    with open(source, 'rb') as sourcef, open(destination, 'r+b') as destinationf:
+        offset = 0
+        for block in iter(lambda: sourcef.read(block_size), b''):
+            if os.pread(destinationf.fileno(), len(block), offset) != block:
+                os.pwrite(destinationf.fileno(), block, offset)
+            offset += len(block)
+
+class VarstorePool(object):
+    """
+        Pool of writable OVMF variable stores (OVMF_VARS.fd), one leased to each
+        virtual machine. A store is a clone of the template (reflink when the
+        filesystem supports it), reset to the template every time it is leased:
+        cloned again when reflinks are cheap, otherwise only its blocks which
+        differ from the template are rewritten. Leases are flock locks, so that
+        concurrent runs never share a store.
+    """
+
+    def __init__(self, directory, template):
+        self._directory = directory
+        self.template = template
+        self._reflink = None
+        self._leases = dict()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _reset(self, path):
+        if self._reflink is not False or not os.path.exists(path) \
+                or os.path.getsize(path) != os.path.getsize(self.template):
+            method = create_disk.clone_file(self.template, path)
+            if self._reflink is None:
+                self._reflink = method == 'reflink'
+                logging.info("varstore pool %s: %s clones", self._directory, method)
+            return
+        rewrite_changed_blocks(self.template, path)
+
+    def acquire(self):
+        """
+            Lease a store reset to the template, return its path
+        """
+        for index in itertools.count():
+            path = os.path.join(self._directory, 'vars-{:03d}.fd'.format(index))
+            lockf = open(path + '.lock', 'a')
+            try:
+                fcntl.flock(lockf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                lockf.close()
+                continue
+            try:
+                self._reset(path)
+            except BaseException:
+                lockf.close()
+                raise
+            self._leases[path] = lockf
+            return path
+
+    def release(self, path):
+        """
+            Give a store back to the pool, its content is kept until its next lease
+        """
+        lockf = self._leases.pop(path)
+        fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+        lockf.close()
+
+    @contextlib.contextmanager
+    def lease(self):
+        path = self.acquire()
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+class QMP(object):
+    """
+        Minimal asynchronous QMP client
+    """
+
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+
+    async def connect(self, path, timeout=10):
+        """
+            Connect to the QMP socket of a starting virtual machine
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(path)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        await self._reader.readline()  # greeting
+        await self.execute('qmp_capabilities')
+
+    async def execute(self, command, **arguments):
+        """
+            Run a command, return its result, raise EnvironmentError on error
+        """
+        message = {'execute': command}
+        if arguments:
+            message['arguments'] = arguments
+        self._writer.write(json.dumps(message).encode() + b'\n')
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise EnvironmentError("QMP connection closed")
+            reply = json.loads(line.decode())
+            if 'event' in reply:
+                continue
+            if 'error' in reply:
+                raise EnvironmentError("QMP {}: {}".format(command, reply['error']['desc']))
+            return reply.get('return')
+
+    async def wait(self, command, done, interval=0.05, **arguments):
+        """
+            Repeat a query until done(result)
+        """
+        while True:
+            result = await self.execute(command, **arguments)
+            if done(result):
+                return result
+            await asyncio.sleep(interval)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+def snapshot_path(args, accel, pool=None):
+    """
+        Path of the snapshot of a virtual machine waiting at the UEFI shell prompt,
+        keyed by everything the state depends on
+    """
+    ovmf = os.path.abspath(args.ovmf)
+    key = [shutil.which(args.qemu) or args.qemu, ovmf, os.path.getmtime(ovmf),
+           accel, args.memory, args.qemu_args]
+    if pool is not None:
+        with open(pool.template, 'rb') as templatef:
+            key.append(hashlib.sha256(templatef.read()).hexdigest())
+    key = json.dumps(key)
+    name = hashlib.sha256(key.encode()).hexdigest()[:16] + '.state'
+    return os.path.join(args.snapshot_dir, name)
+
+async def prepare_snapshot(args, accel, pool=None):
+    """
+        Boot OVMF once to the UEFI shell prompt and save the state of the
+        virtual machine, return the snapshot path
+    """
+    path = snapshot_path(args, accel, pool)
+    if os.path.exists(path):
+        return path
+    if not os.path.isdir(args.snapshot_dir):
+        os.makedirs(args.snapshot_dir)
+    logging.warning("booting OVMF to save snapshot %s", path)
+    workdir = tempfile.mkdtemp(prefix='qemu-snapshot-')
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    qmp = QMP()
+    with contextlib.ExitStack() as stack:
+        varstore = stack.enter_context(pool.lease()) if pool is not None else None
+        process = await asyncio.create_subprocess_exec(
+            *qemu_command(args, None, accel, os.path.join(workdir, 'qmp.sock'), varstore),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        await save_snapshot(args, process, qmp, workdir, temporary, path)
+    return path
+
+async def wait_shell_prompt(process, timeout):
+    """
+        Read the console of a booting virtual machine until the UEFI shell prompt
+    """
+    async def shell_prompt():
+        console = ''
+        while not PROMPT_PATTERN.search(ESCAPE_PATTERN.sub('', console)):
+            data = await process.stdout.read(4096)
+            if not data:
+                raise EnvironmentError("QEMU exited before the UEFI shell prompt")
+            console = (console + data.decode('utf-8', errors='replace'))[-4096:]
+    await asyncio.wait_for(shell_prompt(), timeout)
+
+async def save_snapshot(args, process, qmp, workdir, temporary, path):
+    """
+        Save the state of a virtual machine once it waits at the UEFI shell prompt
+    """
+    try:
+        await wait_shell_prompt(process, args.timeout)
+        await qmp.connect(os.path.join(workdir, 'qmp.sock'))
+        await qmp.execute('stop')
+        await qmp.execute('migrate', uri='exec:cat > {}'.format(shlex.quote(temporary)))
+        status = await qmp.wait('query-migrate',
+                                lambda result: result.get('status') in ('completed', 'failed'))
+        if status['status'] != 'completed':
+            raise EnvironmentError("cannot save snapshot: {}".format(status))
+        os.rename(temporary, path)
+    finally:
+        qmp.close()
+        await kill(process)
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def seed_varstore(args, accel, image, pool):
+    """
+        Boot an image once to the UEFI shell prompt with a fresh variable store,
+        so that the firmware registers its boot options, and use that store as
+        the template of the pool: later boots do not scan for boot options again
+    """
+    with open(pool.template, 'rb') as templatef:
+        key = [hashlib.sha256(templatef.read()).hexdigest(), bool(args.snapshot_dir),
+               args.memory, args.qemu_args]
+    seeded = os.path.join(args.varstore_dir, 'seeded-{}.fd'.format(
+        hashlib.sha256(json.dumps(key).encode()).hexdigest()[:16]))
+    if not os.path.exists(seeded):
+        logging.warning("booting %s to seed variable store %s", image, seeded)
+        workdir = tempfile.mkdtemp(prefix='qemu-seed-')
+        try:
+            overlay = os.path.join(workdir, 'overlay.qcow2')
+            create_disk.create_overlay(image, overlay)
+            with pool.lease() as varstore:
+                process = await asyncio.create_subprocess_exec(
+                    *qemu_command(args, overlay, accel, varstore=varstore),
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+                try:
+                    await wait_shell_prompt(process, args.timeout)
+                finally:
+                    await kill(process)
+                temporary = '{}.{}.tmp'.format(seeded, os.getpid())
+                shutil.copyfile(varstore, temporary)
+                os.rename(temporary, seeded)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    pool.template = seeded
+
+async def restore_snapshot(args, process, qmp_path, overlay):
+    """
+        Wait for the snapshot to be restored and plug the payload in as a USB disk
+    """
+    qmp = QMP()
+    try:
+        await qmp.connect(qmp_path)
+        status = await qmp.wait('query-status',
+                                lambda result: result['status'] != 'inmigrate')
+        if status['status'] != 'running':
+            await qmp.execute('cont')
+        await qmp.execute('blockdev-add', driver='qcow2', **{'node-name': 'payload'},
+                          file={'driver': 'file', 'filename': overlay})
+        await qmp.execute('device_add', driver='usb-storage', bus='xhci.0',
+                          drive='payload', id='payload-disk')
+    finally:
+        qmp.close()
+    # the firmware enumerates the new device on its own
+    await asyncio.sleep(args.attach_delay)
+
+class Verdict(object):
+    """
+        Stream parser of a serial console looking for the pass/fail markers.
+        For a pack of tests, the result of every test is collected and the
+        verdict comes with the final marker: passed if every test returned 0.
+    """
+
+    def __init__(self, pass_pattern, fail_pattern, pack=False):
+        self._pass = re.compile(pass_pattern)
+        self._fail = re.compile(fail_pattern)
+        self._pack = pack
+        self._line = ''
+        self.result = None
+        self.tests = dict()
+        self.order = list()
+
+    def _feed_pack(self, line):
+        result = PACK_RESULT_PATTERN.match(line)
+        if result is not None:
+            name = result.group(1)
+            if name not in self.tests:
+                self.order.append(name)
+            self.tests[name] = int(result.group(2), 0)
+            return
+        result = PACK_DONE_PATTERN.match(line)
+        if result is not None:
+            complete = len(self.tests) == int(result.group(1))
+            success = all(status == 0 for status in self.tests.values())
+            self.result = 'passed' if complete and success else 'failed'
+
+    def feed(self, text):
+        """
+            Parse a chunk of output, return the verdict once there is one
+        """
+        lines = (self._line + text.replace('\r', '')).split('\n')
+        self._line = lines.pop()
+        for line in lines:
+            line = ESCAPE_PATTERN.sub('', line)
+            if self._pack:
+                self._feed_pack(line)
+            elif self._fail.search(line):
+                self.result = 'failed'
+            elif self._pass.search(line):
+                self.result = 'passed'
+            if self.result is not None:
+                break
+        return self.result
+
+    def test_results(self):
+        """
+            Return the (name, status) of the tests of a pack, in order
+        """
+        return [(name, self.tests[name]) for name in self.order]
+
+def parse_pack_log(logname):
+    """
+        Turn the console log of a pack of tests into its verdict and the
+        (name, status) of every test which ran
+    """
+    verdict = Verdict('', '', pack=True)
+    with open(logname, 'rb') as logf:
+        verdict.feed(logf.read().decode('utf-8', errors='replace') + '\n')
+    return verdict.result or 'no-verdict', verdict.test_results()
+
+async def kill(process):
+    """
+        Kill a virtual machine, no shutdown is needed since its disk is thrown away
+    """
+    if process.returncode is None:
+        process.kill()
+    await process.wait()
+
+async def run_vm(args, index, image, accel, slots, snapshot=None, pool=None):
+    """
+        Boot an image on its own overlay (and variable store, with a pool) until
+        a verdict appears or the timeout expires
+    """
+    async with slots:
+        start = time.time()
+        name = '{:03d}-{}'.format(index, os.path.basename(image))
+        result = {'image': image, 'name': name, 'verdict': None, 'accel': accel, 'log': None}
+        workdir = tempfile.mkdtemp(prefix='qemu-runner-')
+        logf = None
+        varstore = None
+        try:
+            if pool is not None:
+                varstore = pool.acquire()
+                result['varstore'] = varstore
+            overlay = os.path.join(workdir, 'overlay.qcow2')
+            create_disk.create_overlay(image, overlay)
+            if args.log_dir:
+                result['log'] = os.path.join(args.log_dir, name + '.log')
+                logf = open(result['log'], 'wb')
+            qmp_path = os.path.join(workdir, 'qmp.sock') if snapshot else None
+            command = qemu_command(args, overlay, accel, qmp_path, varstore)
+            if snapshot:
+                command.extend(['-incoming', 'exec:cat {}'.format(shlex.quote(snapshot))])
+            logging.info("%s: %s", name, ' '.join(command))
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.PIPE if snapshot else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            verdict = Verdict(args.pass_pattern, args.fail_pattern, args.pack)
+            commands = list(SNAPSHOT_COMMANDS) if snapshot else list()
+
+            def type_command():
+                process.stdin.write(commands.pop(0).encode() + b'\r')
+
+            async def console():
+                if snapshot:
+                    await restore_snapshot(args, process, qmp_path, overlay)
+                    type_command()
+                prompts = ''
+                while verdict.result is None:
+                    data = await process.stdout.read(4096)
+                    if not data:
+                        return 'no-verdict'
+                    if logf is not None:
+                        logf.write(data)
+                    text = data.decode('utf-8', errors='replace')
+                    verdict.feed(text)
+                    # the next command is typed at the next prompt
+                    prompts = ESCAPE_PATTERN.sub('', prompts + text)[-256:]
+                    if commands and PROMPT_PATTERN.search(prompts):
+                        prompts = ''
+                        type_command()
+                return verdict.result
+
+            try:
+                result['verdict'] = await asyncio.wait_for(console(), args.timeout)
+            except asyncio.TimeoutError:
+                result['verdict'] = 'timeout'
+            finally:
+                await kill(process)
+                if args.pack:
+                    result['tests'] = verdict.test_results()
+        except Exception as error:
+            logging.exception("%s: cannot run", name)
+            result['verdict'] = 'error'
+            result['error'] = '{}: {}'.format(type(error).__name__, error)
+        finally:
+            if logf is not None:
+                logf.close()
+            if varstore is not None:
+                pool.release(varstore)
+            shutil.rmtree(workdir, ignore_errors=True)
+        result['seconds'] = time.time() - start
+        return result
+
+async def run_all(args, images, accel):
+    """
+        Boot every image, at most args.jobs at the same time
+    """
+    pool = None
+    if args.ovmf_vars:
+        pool = VarstorePool(args.varstore_dir, args.ovmf_vars)
+        if args.seed_varstore:
+            await seed_varstore(args, accel, images[0], pool)
+    snapshot = None
+    if args.snapshot_dir:
+        snapshot = await prepare_snapshot(args, accel, pool)
+    slots = asyncio.Semaphore(args.jobs)
+    return await asyncio.gather(*[run_vm(args, index, image, accel, slots, snapshot, pool)
+                                  for index, image in enumerate(images)])
+
+def parse_args():
+    """
+        Parse the script arguments
+    """
+    parser = argparse.ArgumentParser(description='Boot disk images in headless QEMU virtual '\
+                                     'machines, concurrently, and check their verdict.')
+    parser.add_argument('images', nargs='*', metavar='IMAGE',
+                        help='disk images to boot (raw or qcow2), never modified')
+    parser.add_argument('--ovmf', metavar='OVMF',
+                        help='OVMF firmware (OVMF.fd, or OVMF_CODE.fd with --ovmf-vars)')
+    parser.add_argument('--ovmf-vars', metavar='OVMF_VARS',
+                        help='template of the variable store each virtual machine gets '\
+                        'a writable copy of')
+    parser.add_argument('--varstore-dir', metavar='DIRECTORY',
+                        help='pool of variable stores, shared by concurrent runs '\
+                        '($XDG_CACHE_HOME/uefi-test/varstores by default)')
+    parser.add_argument('--seed-varstore', action='store_true',
+                        help='boot the first image once so that the variable stores '\
+                        'start with its boot options')
+    parser.add_argument('--pack', action='store_true',
+                        help='the images hold packs of tests (create_disk.py --pack): '\
+                        'report the result of every test')
+    parser.add_argument('--parse-log', metavar='LOG',
+                        help='only report the results of a pack of tests from its console log')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of virtual machines booting each image')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of virtual machines running at the same time')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds after which a virtual machine without verdict is killed')
+    parser.add_argument('--accel', choices=['auto', 'kvm', 'tcg'], default='auto',
+                        help='TCG is used when KVM is not available (auto)')
+    parser.add_argument('--memory', type=int, default=256, metavar='MB')
+    parser.add_argument('--snapshot-dir', metavar='DIRECTORY',
+                        help='boot OVMF to the UEFI shell once, save its state in this '\
+                        'directory and restore it for every virtual machine')
+    parser.add_argument('--attach-delay', type=float, default=1,
+                        metavar='SECONDS',
+                        help='in snapshot mode, time left to the firmware to find the payload')
+    parser.add_argument('--qemu', default='qemu-system-x86_64',
+                        help='QEMU executable')
+    parser.add_argument('--qemu-args', nargs=argparse.REMAINDER, default=list(),
+                        help='extra QEMU arguments (last option)')
+    parser.add_argument('--pass-pattern', default=r'^\s*PASSED\s*$',
+                        help='regular expression of a console line reporting a success')
+    parser.add_argument('--fail-pattern', default=r'^\s*FAILED\s*$',
+                        help='regular expression of a console line reporting a failure')
+    parser.add_argument('--log-dir', metavar='DIRECTORY',
+                        help='keep the console of every virtual machine in this directory')
+    parser.add_argument('--report', metavar='REPORT',
+                        help='write the per virtual machine results to this JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    if args.parse_log is None and (not args.images or args.ovmf is None):
+        parser.error("IMAGE and --ovmf are required")
+    if args.seed_varstore and not args.ovmf_vars:
+        parser.error("--seed-varstore requires --ovmf-vars")
+    if args.ovmf_vars and args.varstore_dir is None:
+        # a packaged firmware directory (/usr/share/OVMF) is not writable
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),
+                                                                 '.cache')
+        args.varstore_dir = os.path.join(cache, 'uefi-test', 'varstores')
+    return args
+
+def print_tests(tests):
+    """
+        Print the result of every test of a pack
+    """
+    for name, status in tests:
+        print("    {:10s} {}".format('passed' if status == 0 else
+                                     'failed({:#x})'.format(status), name))
+
+def run(args):
+    """
+        main function
+    """
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    if args.parse_log:
+        verdict, tests = parse_pack_log(args.parse_log)
+        print_tests(tests)
+        print("{}: {} tests, {} failed".format(verdict, len(tests),
+                                              sum(1 for _, status in tests if status)))
+        return 0 if verdict == 'passed' else 1
+    if args.log_dir and not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+    accel = accelerator(args.accel)
+    if accel == 'tcg':
+        logging.warning("KVM not available, virtual machines run with TCG")
+    images = [image for image in args.images for _ in range(args.repeat)]
+
+    start = time.time()
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(run_all(args, images, accel))
+    finally:
+        loop.close()
+    elapsed = time.time() - start
+
+    for result in results:
+        print("{verdict:10s} {seconds:7.3f}s {name}".format(**result))
+        print_tests(result.get('tests', list()))
+    failures = sum(1 for result in results if result['verdict'] != 'passed')
+    print("{} passed in {:.3f}s, {} failed ({})".format(len(results) - failures,
+                                                       elapsed, failures, accel))
+    if args.report:
+        with open(args.report, 'w') as reportf:
+            json.dump({'seconds': elapsed, 'accel': accel, 'vms': results}, reportf, indent=2)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(run(parse_args()))